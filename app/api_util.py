@@ -1,21 +1,290 @@
-import openai 
-import streamlit as st 
+import contextlib
 import datetime 
-import pytz 
+import functools
 import time 
+import concurrent.futures
+import contextvars
+import queue 
+import dataclasses
+import hashlib
+import operator
+import threading
+import weakref
+import cachetools
+import random
+import rate_limit
+import token_util
+import model_registry
+import instrumentation
+import logging
+import cache_util
 
 def get_current_time():
-    return datetime.datetime.now(pytz.timezone('US/Pacific'))
-
-def escape_special_chars(text):
-    return (
-        text.replace("\\", "\\\\")
-        .replace("\"", "\\\"")
-        .replace("'", "\\'")
-        .replace("\n", "\\n")
-        .replace("\t", "\\t")
-        .replace("\r", "\\r")
-    )  
+    return datetime.datetime.now(_get_timezone())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_timezone():
+    # built once per process; zoneinfo (Python 3.9+) saves importing pytz 
+    try:
+        import zoneinfo
+        return zoneinfo.ZoneInfo('US/Pacific')
+    except (ImportError, KeyError):
+        import pytz
+        return pytz.timezone('US/Pacific')
+
+
+def _import_openai():
+    """The openai module, imported on first use rather than with this one: it brings in requests, aiohttp and pandas, 
+    which would otherwise be most of the app's cold start"""
+    import openai
+    import openai.api_requestor
+    return openai
+
+
+def _is_quota_error(e):
+    # running out of quota is reported as a rate limit error, but waiting will not fix it 
+    error_type = ((e.json_body or {}).get('error') or {}).get('type') if isinstance(e.json_body, dict) else None
+    return error_type == 'insufficient_quota' or 'exceeded your current quota' in str(e)
+
+
+def _retry_after(e):
+    try:
+        return float(e.headers.get('Retry-After') or e.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+# how often idle pools are looked for; a pool's sockets close within this long after its idle timeout 
+POOL_REAP_INTERVAL = 15
+_live_pools = weakref.WeakSet()
+_live_pools_lock = threading.Lock()
+_pool_reaper = None
+
+
+class connection_pool:
+    """Keep-alive HTTP connection pool shared by every call made with one API key.
+    openai keeps a requests session per thread, so calls borrow the pool's session for their thread instead.
+    A background reaper closes the session once it has been idle for idle_timeout, even if the key is never used again."""
+
+    def __init__(self, pool_size=10, idle_timeout=90):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._session = None
+        self._last_used = 0.0
+        self._active_calls = 0
+        _register_pool(self)
+
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Routes the openai calls made by the current thread through the pooled session"""
+        thread_context = _import_openai().api_requestor._thread_context
+        previous_session = getattr(thread_context, 'session', None)
+        thread_context.session = self._get_session()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active_calls -= 1
+                self._last_used = time.monotonic()
+            if previous_session is None:
+                del thread_context.session
+            else:
+                thread_context.session = previous_session
+
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+    def close_if_idle(self):
+        """Closes the session if no call has used it for idle_timeout; returns whether it did"""
+        with self._lock:
+            if self._session is None or self._active_calls > 0 or time.monotonic() - self._last_used <= self.idle_timeout:
+                return False
+            self._session.close()
+            self._session = None
+            return True
+
+
+    def _get_session(self):
+        with self._lock:
+            now = time.monotonic()
+            # the server drops idle keep-alive connections, so start over rather than hit a dead socket 
+            if self._session is not None and self._active_calls == 0 and now - self._last_used > self.idle_timeout:
+                self._session.close()
+                self._session = None
+
+            if self._session is None:
+                openai = _import_openai()
+                import requests.adapters
+                self._session = openai.api_requestor._make_session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=openai.api_requestor.MAX_CONNECTION_RETRIES)
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+
+            self._last_used = now
+            self._active_calls += 1
+            return self._session
+
+
+def _register_pool(pool):
+    # the reaper thread starts with the first pool, so importing this module stays cheap 
+    global _pool_reaper
+    with _live_pools_lock:
+        _live_pools.add(pool)
+        if _pool_reaper is None:
+            _pool_reaper = threading.Thread(target=_reap_idle_pools, name='connection-pool-reaper', daemon=True)
+            _pool_reaper.start()
+
+
+def _reap_idle_pools():
+    while True:
+        time.sleep(POOL_REAP_INTERVAL)
+        with _live_pools_lock:
+            pools = list(_live_pools)
+        for pool in pools:
+            pool.close_if_idle()
+
+
+# moderation verdicts depend only on the text, so they are memoized by content hash and shared across sessions 
+_moderation_verdicts = cachetools.LRUCache(maxsize=4096)
+_moderation_verdicts_lock = threading.Lock()
+
+# calls with a deadline or a hedge run here, so the caller can stop waiting on them; abandoned calls finish in the background 
+_call_executor = concurrent.futures.ThreadPoolExecutor(max_workers=64, thread_name_prefix='openai-call')
+
+# API limits on batching in one request: samples per prompt (n), and prompts per Completion request 
+MAX_SAMPLES_PER_REQUEST = 128
+MAX_PROMPTS_PER_REQUEST = 20
+
+# hedging waits for this many observed responses of a model before trusting its p95 
+HEDGE_MIN_SAMPLES = 20
+
+# encoded chat histories, keyed by the history list each conversation is kept in and shared across sessions 
+_serialized_histories = cachetools.LRUCache(maxsize=1024)
+_serialized_histories_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class open_ai_request:
+    """A structured OpenAI API call: the client resource, its method and the keyword arguments passed straight to it"""
+    resource: str
+    method: str = 'create'
+    params: dict = dataclasses.field(default_factory=dict)
+    # credentials travel with the request instead of through the openai module globals 
+    api_key: str = dataclasses.field(default=None, repr=False)
+
+    def invoke(self, timeout=None):
+        # not every resource accepts a request_timeout, so it is only passed when set 
+        options = {'request_timeout': timeout} if timeout is not None else {}
+        return getattr(getattr(_import_openai(), self.resource), self.method)(**self.params, api_key=self.api_key, **options)
+
+    def estimated_tokens(self):
+        """Pre-flight token cost of the call: the prompt size plus the completion budget"""
+        return self._estimated_prompt_tokens() + self._estimated_completion_tokens()
+
+    def estimated_cost(self):
+        """Upper bound of the call's cost in $, assuming the whole completion budget is used"""
+        pricing = model_registry.get_pricing(self.params.get('model'))
+        return (self._estimated_prompt_tokens() * pricing['prompt'] + self._estimated_completion_tokens() * pricing['completion']) / 1000
+
+    def _estimated_prompt_tokens(self):
+        # chat messages recur from turn to turn, so their counts come from the shared memoized counter 
+        model = self.params.get('model')
+        prompts = self.params.get('prompt', '')
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        message_tokens = sum(token_util.shared_counter.count_message(model, message['content']) + token_util.CHAT_TOKENS_PER_MESSAGE for message in self.params.get('messages', []))
+        return message_tokens + sum(token_util.count_text_tokens(prompt, model) for prompt in prompts)
+
+    def _estimated_completion_tokens(self):
+        # a batched completion request generates n completions for each of its prompts 
+        prompts = self.params.get('prompt')
+        prompt_count = len(prompts) if isinstance(prompts, list) else 1
+        return self.params.get('max_tokens', 0) * self.params.get('n', 1) * prompt_count
+
+
+class hedge_budget:
+    """Caps the extra spend on hedged duplicate requests, charged at each duplicate's estimated cost"""
+
+    def __init__(self, max_extra_cost=0.10):
+        self.max_extra_cost = max_extra_cost
+        self.spent = 0.0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+
+    def try_spend(self, cost):
+        """Charges cost to the budget and returns True, or returns False if it would go over the cap"""
+        with self._lock:
+            if self.spent + cost > self.max_extra_cost:
+                return False
+            self.spent += cost
+            self.hedges += 1
+            return True
+
+
+class serialized_history:
+    """Encoded forms of a growing message history. Each message is encoded once and the completion prompt
+    prefix is accumulated, so a new turn only encodes the messages appended since the previous call.
+    The whole history is encoded, and a request trimmed to its latest messages takes them as a window."""
+
+    def __init__(self, stop_sequence, restart_sequence):
+        self.stop_sequence = stop_sequence
+        self.restart_sequence = restart_sequence
+        self.lock = threading.Lock()
+        self._reset()
+
+
+    def extend(self, messages):
+        """Brings the encodings up to date with messages, which normally start with the messages already encoded"""
+        encoded = len(self.messages)
+        # only the very same message objects count as already encoded: another conversation can end with a shared turn 
+        if len(messages) < encoded or not all(map(operator.is_, messages, self.messages)):
+            # the history was edited rather than appended to, or belongs to a different conversation 
+            self._reset()
+            encoded = 0
+
+        new_parts = []
+        offset = len(self.prompt)
+        for message in messages[encoded:]:
+            self.messages.append(message)
+            self.oai_messages.append({'role':message['role'], 'content':message['message']})
+            self.prompt_offsets.append(offset)
+            if message['role'] == 'user' or message['role'] == 'system':
+                new_parts.append(message['message'] + self.stop_sequence)
+            else:
+                new_parts.append(message['message'] + self.restart_sequence)
+            offset += len(new_parts[-1])
+
+        if len(new_parts) > 0:
+            self.prompt = self.prompt + ''.join(new_parts)
+
+
+    def oai_messages_window(self, count):
+        """The chat messages of the latest count messages"""
+        return self.oai_messages[len(self.oai_messages) - count:]
+
+
+    def prompt_window(self, count):
+        """The completion prompt of the latest count messages"""
+        if count == 0:
+            return ''
+        return self.prompt[self.prompt_offsets[len(self.prompt_offsets) - count]:]
+
+
+    def _reset(self):
+        self.messages = []
+        self.oai_messages = []
+        # where each message starts in the prompt, so a window of it is a single slice 
+        self.prompt_offsets = []
+        self.prompt = ''
+
 
 class open_ai:
 
@@ -27,48 +296,193 @@ class open_ai:
             super().__init__(message)
             self.error_type = error_type 
 
-    def __init__(self, api_key, restart_sequence, stop_sequence):
+    class DeadlineExceeded(OpenAIError):
+        def __init__(self, model):
+            super().__init__(f"{model} did not respond before its deadline", error_type='DeadlineExceeded')
+            self.model = model
+
+    def __init__(self, api_key, restart_sequence, stop_sequence, cache=None, cache_nondeterministic=False, rate_limiter=rate_limit.shared_limiter, pool=None, hooks=None, latency_store=None, hedge_budget=None):
         self.api_key = api_key
-        openai.api_key = api_key 
+        # calls reuse the connections of the pool, which should be shared by every client of the same key 
+        self.pool = pool if pool is not None else connection_pool()
         self.stop_sequence = stop_sequence
         self.restart_sequence = restart_sequence
-
-
-    def _invoke_call(self, call_string, max_tries=3, initial_backoff=1):
-        """Generic function to invoke openai calls"""
+        # responses are only cached when a cache is passed in, and by default only for temperature 0 requests 
+        self.cache = cache
+        self.cache_nondeterministic = cache_nondeterministic
+        # model calls are budgeted against the key's requests/min and tokens/min before they are sent 
+        self.rate_limiter = rate_limiter
+        self.token_counter = token_util.shared_counter
+        # instrumentation hooks are called with every finished span (see instrumentation.py)
+        self.hooks = list(hooks or [])
+        # hedged requests fire at the model's p95 network latency in latency_store (an instrumentation.histogram_store), 
+        # and are only sent while a hedge_budget is passed in 
+        self.latency_store = latency_store
+        self.hedge_budget = hedge_budget
+        if latency_store is not None and latency_store.record not in self.hooks:
+            self.hooks.append(latency_store.record)
+
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+
+    def _invoke_call(self, request, max_tries=3, initial_backoff=1, deadline_at=None):
+        """Generic function to invoke openai calls; deadline_at is a time.monotonic() time the call must finish by"""
+        request.api_key = self.api_key
+        openai = _import_openai()
         RETRY_EXCEPTIONS = (
             openai.error.APIError, 
             openai.error.Timeout, 
             openai.error.APIConnectionError, 
-            openai.error.ServiceUnavailableError
+            openai.error.ServiceUnavailableError,
+            openai.error.RateLimitError
         )
         tries = 0
         backoff = initial_backoff
+        model = request.params.get('model')
+        rate_limited = self.rate_limiter is not None and model is not None
 
         while True: 
+            if rate_limited:
+                estimated_tokens = request.estimated_tokens()
+                with self._span('rate_limit_wait', model=model, estimated_tokens=estimated_tokens):
+                    self.rate_limiter.acquire(self.api_key, model, estimated_tokens)
+
+            timeout = None
+            if deadline_at is not None:
+                timeout = deadline_at - time.monotonic()
+                if timeout <= 0:
+                    if rate_limited:
+                        self.rate_limiter.settle(self.api_key, model, estimated_tokens, 0)
+                    raise self.DeadlineExceeded(model)
+
             try:
-                result = eval(f"{call_string}")
+                with self._span('network', model=model, resource=request.resource, attempt=tries + 1), self.pool.activate():
+                    result = request.invoke(timeout=timeout)
+                if rate_limited and isinstance(result, dict) and 'usage' in result:
+                    self.rate_limiter.settle(self.api_key, model, estimated_tokens, result['usage']['total_tokens'])
                 return result     
 
             except Exception as e:
-                if isinstance(e, RETRY_EXCEPTIONS) and tries < max_tries:
-                    time.sleep(backoff)
+                # a failed attempt gives its reservation back, so retries don't drain the key's token budget for every session 
+                if rate_limited:
+                    self.rate_limiter.settle(self.api_key, model, estimated_tokens, 0)
+                if isinstance(e, RETRY_EXCEPTIONS) and not (isinstance(e, openai.error.RateLimitError) and _is_quota_error(e)) and tries < max_tries:
+                    # honour the server's Retry-After, otherwise back off exponentially with jitter 
+                    delay = _retry_after(e)
+                    if delay is None:
+                        delay = random.uniform(backoff / 2, backoff)
+                    if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+                        raise self.DeadlineExceeded(model) from e
+                    if rate_limited and isinstance(e, openai.error.RateLimitError):
+                        self.rate_limiter.penalize(self.api_key, model, delay)
+                    with self._span('retry_sleep', model=model, attempt=tries + 1, error_type=type(e).__name__):
+                        time.sleep(delay)
                     backoff *= 2
                     tries +=1
                 else:
                     raise self.OpenAIError(f"OpenAI API Error: {str(e)}", error_type=type(e).__name__) from e  
 
 
+    def _invoke_cached_call(self, request, deadline=None, hedge=False):
+        """Invokes a completion request through the response cache when the request is cacheable"""
+        cacheable = (
+            self.cache is not None 
+            and not request.params.get('stream', False) 
+            and (self.cache_nondeterministic or request.params.get('temperature') == 0)
+        )
+        if not cacheable:
+            return self._invoke_bounded_call(request, deadline, hedge)
+
+        key = self.cache.make_key(hashlib.sha256(self.api_key.encode('utf-8')).hexdigest(), request.resource, request.params)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._invoke_bounded_call(request, deadline, hedge)
+            self.cache.set(key, result)
+        return result
+
+
+    def _invoke_bounded_call(self, request, deadline=None, hedge=False):
+        """Invokes a call that must finish within deadline seconds. When hedging, a duplicate request is sent
+        if the first is not back by the model's observed p95, and whichever finishes first wins."""
+        model = request.params.get('model')
+        hedge_after = None
+        if hedge and self.hedge_budget is not None and self.latency_store is not None:
+            hedge_after = self.latency_store.quantile('network', 0.95, model=model, min_count=HEDGE_MIN_SAMPLES)
+        if deadline is None and hedge_after is None:
+            return self._invoke_call(request)
+
+        deadline_at = time.monotonic() + deadline if deadline is not None else None
+        futures = [self._submit_call(request, deadline_at)]
+        try:
+            if hedge_after is not None:
+                done, _ = concurrent.futures.wait(futures, timeout=self._time_left(deadline_at, hedge_after))
+                if len(done) == 0 and self.hedge_budget.try_spend(request.estimated_cost()):
+                    self._emit_span('hedge', time.time(), 0.0, model=model, hedge_after=hedge_after)
+                    futures.append(self._submit_call(request, deadline_at))
+
+            while True:
+                done, pending = concurrent.futures.wait(futures, timeout=self._time_left(deadline_at), return_when=concurrent.futures.FIRST_COMPLETED)
+                if len(done) == 0:
+                    raise self.DeadlineExceeded(model)
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                if len(pending) == 0:
+                    return done.pop().result()
+                # the other request may still succeed 
+                futures = list(pending)
+        finally:
+            # requests already in flight can't be recalled; the loser's result is dropped when it lands 
+            for future in futures:
+                future.cancel()
+
+
+    def _submit_call(self, request, deadline_at):
+        # carry the caller's call id over to the worker thread 
+        context = contextvars.copy_context()
+        return _call_executor.submit(context.run, self._invoke_call, request, deadline_at=deadline_at)
+
+
+    @staticmethod
+    def _time_left(deadline_at, limit=None):
+        if deadline_at is None:
+            return limit
+        time_left = max(deadline_at - time.monotonic(), 0)
+        return time_left if limit is None else min(time_left, limit)
+
+
     def get_moderation(self, user_message):
-        """Main function to get moderation on a user message"""
-        get_moderation_call_string = ("""openai.Moderation.create(input="{0}")""".format(escape_special_chars(user_message)))
+        """Main function to get moderation on a user message, or on a list of messages in one batched request"""
+        user_messages = [user_message] if isinstance(user_message, str) else list(user_message)
+        keys = [hashlib.sha256(message.encode('utf-8')).hexdigest() for message in user_messages]
+
+        # only send text whose verdict is not already memoized 
+        with _moderation_verdicts_lock:
+            verdicts = {key: _moderation_verdicts[key] for key in keys if key in _moderation_verdicts}
+        pending = {}
+        for key, message in zip(keys, user_messages):
+            if key not in verdicts:
+                pending.setdefault(key, message)
 
         try:
-            moderation = self._invoke_call(get_moderation_call_string)
-            moderation_result = moderation['results'][0]
-            flagged_categories = [category for category, value in moderation_result['categories'].items() if value]
-
-            return {'flagged': moderation_result['flagged'], 'flagged_categories':flagged_categories}
+            if len(pending) > 0:
+                get_moderation_request = open_ai_request('Moderation', params={'input':list(pending.values())})
+                # a moderation request is a call of its own, so its network and retry spans are tied to it 
+                with instrumentation.call_context(), self._span('moderation', inputs=len(pending)):
+                    moderation = self._invoke_call(get_moderation_request)
+
+                for key, moderation_result in zip(pending.keys(), moderation['results']):
+                    flagged_categories = [category for category, value in moderation_result['categories'].items() if value]
+                    verdicts[key] = {'flagged': moderation_result['flagged'], 'flagged_categories':flagged_categories}
+
+                with _moderation_verdicts_lock:
+                    for key in pending.keys():
+                        _moderation_verdicts[key] = verdicts[key]
+
+            results = [dict(verdicts[key]) for key in keys]
+            return results[0] if isinstance(user_message, str) else results
         except Exception as e:
             raise 
 
@@ -76,108 +490,374 @@ class open_ai:
     def get_models(self):
         """Main function to get models that the key has access to """
         try:
-            return self._invoke_call("openai.Model.list()")
+            return self._invoke_call(open_ai_request('Model', method='list'))
         except Exception as e:
             raise
 
 
     def get_ai_response(self, model_config_dict, init_prompt_msg, messages):
+        with instrumentation.call_context(), self._span('call', model=model_config_dict['model']) as span:
+            b_r = self._get_ai_response(model_config_dict, init_prompt_msg, messages)
+            span.update(prompt_tokens=b_r['prompt_tokens'], completion_tokens=b_r['completion_tokens'], cached=b_r['cached'])
+            return b_r
+
+
+    def _get_ai_response(self, model_config_dict, init_prompt_msg, messages):
 
         submit_messages = [{'role':'system','message':init_prompt_msg,'current_date':get_current_time()}]+ messages
+        submit_messages, trimmed_messages = self._fit_context_window(model_config_dict, submit_messages)
 
         new_messages = [] 
         bot_message = ''
         total_tokens = 0
 
-        if model_config_dict['model'] in ('gpt-3.5-turbo', 'gpt-4'):
+        if model_registry.is_chat_model(model_config_dict['model']):
             try:
-                response = self._get_chat_completion(model_config_dict, submit_messages)
-                bot_message = response['choices'][0]['message']['content']
-                total_tokens = response['usage']['total_tokens']
-                prompt_tokens = response['usage']['prompt_tokens']
-                completion_tokens = response['usage']['completion_tokens']
+                response = self._get_chat_completion(model_config_dict, submit_messages, history_messages=messages)
+                with self._span('parsing', model=model_config_dict['model']):
+                    bot_message = response['choices'][0]['message']['content']
+                    total_tokens = response['usage']['total_tokens']
+                    prompt_tokens = response['usage']['prompt_tokens']
+                    completion_tokens = response['usage']['completion_tokens']
             except Exception as e:
                 raise 
         else:
             try:
-                response = self._get_completion(model_config_dict, submit_messages)
-                bot_message = response['choices'][0]['text']
-                total_tokens = response['usage']['total_tokens']
-                prompt_tokens = response['usage']['prompt_tokens']
-                completion_tokens = response['usage']['completion_tokens']
+                response = self._get_completion(model_config_dict, submit_messages, history_messages=messages)
+                with self._span('parsing', model=model_config_dict['model']):
+                    bot_message = response['choices'][0]['text']
+                    total_tokens = response['usage']['total_tokens']
+                    prompt_tokens = response['usage']['prompt_tokens']
+                    completion_tokens = response['usage']['completion_tokens']
             except Exception as e:
                 raise
         
         new_messages = messages + [{'role':'assistant','message':bot_message.strip(),'created_date':get_current_time()}]
 
-        return {'messages':new_messages, 'total_tokens':total_tokens, 'prompt_tokens':prompt_tokens, 'completion_tokens': completion_tokens}   
+        return {'messages':new_messages, 'total_tokens':total_tokens, 'prompt_tokens':prompt_tokens, 'completion_tokens': completion_tokens, 'cached': isinstance(response, cache_util.cached_response), 'trimmed_messages': trimmed_messages}   
 
 
-    def _get_chat_completion(self, model_config_dict, messages):
-        self._validate_model_config(model_config_dict)
-        oai_messages = self._messages_to_oai_messages(messages)
-
-        get_completion_call_string = (
-        """openai.ChatCompletion.create(
-            model="{0}",
-            messages={1},
-            temperature={2},
-            max_tokens={3},
-            top_p={4},
-            frequency_penalty={5},
-            presence_penalty={6},
-            stop=['{7}']
-            )""").format(
-                model_config_dict['model'],
-                oai_messages,
-                model_config_dict['temperature'],
-                model_config_dict['max_tokens'],
-                model_config_dict['top_p'],
-                model_config_dict['frequency_penalty'],
-                model_config_dict['presence_penalty'],
-                self.stop_sequence
-            )            
-        
+    def get_ai_responses(self, model_config_dicts, init_prompt_msg, messages_by_model, max_workers=None):
+        """Fans out get_ai_response across models concurrently, yielding (model, response, error) as each model finishes"""
+        if len(model_config_dicts) == 0:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(model_config_dicts)) as executor:
+            futures = {
+                executor.submit(self.get_ai_response, model_config_dict, init_prompt_msg, messages_by_model[model_config_dict['model']]): model_config_dict['model']
+                for model_config_dict in model_config_dicts
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    yield futures[future], None, e
+
+
+    def stream_ai_response(self, model_config_dict, init_prompt_msg, messages):
+        """Streams a model response, yielding {'delta': text} chunks and then a final response dict with latency stats"""
+        with instrumentation.call_context(), self._span('call', model=model_config_dict['model'], stream=True) as span:
+            for event in self._stream_ai_response(model_config_dict, init_prompt_msg, messages):
+                if 'delta' not in event:
+                    span.update(prompt_tokens=event['prompt_tokens'], completion_tokens=event['completion_tokens'], time_to_first_token=event['time_to_first_token'])
+                yield event
+
+
+    def _stream_ai_response(self, model_config_dict, init_prompt_msg, messages):
+
+        submit_messages = [{'role':'system','message':init_prompt_msg,'current_date':get_current_time()}]+ messages
+        submit_messages, trimmed_messages = self._fit_context_window(model_config_dict, submit_messages)
+        is_chat_model = model_registry.is_chat_model(model_config_dict['model'])
+
+        deadline = model_config_dict.get('deadline')
+        start_time = time.perf_counter()
+        if is_chat_model:
+            request = self._chat_completion_request(model_config_dict, submit_messages, stream=True, history_messages=messages)
+        else:
+            request = self._completion_request(model_config_dict, submit_messages, stream=True, history_messages=messages)
+        response = self._invoke_cached_call(request, deadline=deadline)
+
+        bot_message_chunks = []
+        time_to_first_token = None
+        completion_tokens = 0
+        stream_start = time.perf_counter()
+
         try:
-            completions = self._invoke_call(get_completion_call_string)
+            for chunk in response:
+                if deadline is not None and time.perf_counter() - start_time > deadline:
+                    raise self.DeadlineExceeded(model_config_dict['model'])
+                if is_chat_model:
+                    delta = chunk['choices'][0]['delta'].get('content', '')
+                else:
+                    delta = chunk['choices'][0]['text']
+                if not delta:
+                    continue
+
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start_time
+                # the API sends one token per streamed chunk 
+                completion_tokens += 1
+                bot_message_chunks.append(delta)
+                yield {'delta': delta}
+        except self.DeadlineExceeded:
+            raise
+        except Exception as e:
+            # a stalled stream is cut off by the read timeout the deadline set, rather than at the next chunk 
+            if deadline is not None and time.perf_counter() - start_time >= deadline:
+                raise self.DeadlineExceeded(model_config_dict['model']) from e
+            raise self.OpenAIError(f"OpenAI API Error: {str(e)}", error_type=type(e).__name__) from e
+        finally:
+            # streamed responses carry no usage block, so prompt tokens are counted locally 
+            prompt_tokens = self.token_counter.count_messages(model_config_dict['model'], submit_messages, self._separator_tokens(model_config_dict['model']))
+            # the call's reservation is settled here, with what was sent and streamed back before the stream ended or was cut off 
+            if self.rate_limiter is not None:
+                self.rate_limiter.settle(self.api_key, model_config_dict['model'], request.estimated_tokens(), prompt_tokens + completion_tokens)
+
+        elapsed = time.perf_counter() - start_time
+        generation_time = elapsed - (time_to_first_token or 0)
+        # time spent receiving the streamed body, after the request itself returned 
+        stream_time = time.perf_counter() - stream_start
+        self._emit_span('stream', time.time() - stream_time, stream_time, model=model_config_dict['model'], completion_tokens=completion_tokens)
+
+        bot_message = ''.join(bot_message_chunks)
+        new_messages = messages + [{'role':'assistant','message':bot_message.strip(),'created_date':get_current_time()}]
+
+        yield {
+            'messages':new_messages, 
+            'total_tokens':prompt_tokens + completion_tokens, 
+            'prompt_tokens':prompt_tokens, 
+            'completion_tokens':completion_tokens,
+            'time_to_first_token':time_to_first_token,
+            'tokens_per_sec':completion_tokens / generation_time if generation_time > 0 else None,
+            'cached':False,
+            'trimmed_messages':trimmed_messages
+        }
+
+
+    def stream_ai_responses(self, model_config_dicts, init_prompt_msg, messages_by_model, max_workers=None):
+        """Streams several models concurrently, yielding (model, event, error) in arrival order across models"""
+        if len(model_config_dicts) == 0:
+            return
+
+        events = queue.Queue()
+        stream_done = object()
+
+        def _pump(model_config_dict):
+            model = model_config_dict['model']
+            try:
+                for event in self.stream_ai_response(model_config_dict, init_prompt_msg, messages_by_model[model]):
+                    events.put((model, event, None))
+            except Exception as e:
+                events.put((model, None, e))
+            finally:
+                events.put((model, stream_done, None))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(model_config_dicts)) as executor:
+            for model_config_dict in model_config_dicts:
+                executor.submit(_pump, model_config_dict)
+
+            pending = len(model_config_dicts)
+            while pending > 0:
+                model, event, error = events.get()
+                if event is stream_done:
+                    pending -= 1
+                else:
+                    yield model, event, error
+
+
+    def get_ai_sweep(self, model_config_dict, conversations, param_grid, samples=1, max_workers=None):
+        """Samples each (init_prompt_msg, messages) conversation `samples` times at every point of param_grid, a list of
+        sampling parameter overrides. Samples share a request through n, and completion models also batch the
+        conversations into one request as a prompt list, with each request sized to fit the model's token budget."""
+        model = model_config_dict['model']
+        is_chat_model = model_registry.is_chat_model(model)
+        tokens_per_request = (self.rate_limiter.tokens_per_minute(model) if self.rate_limiter is not None else rate_limit.DEFAULT_LIMITS.get(model, rate_limit.FALLBACK_LIMIT)[1])
+
+        requests = []
+        for point_index, point in enumerate(param_grid):
+            point_config_dict = {**model_config_dict, **point}
+            self._validate_model_config(point_config_dict)
+            max_tokens = max(point_config_dict['max_tokens'], 1)
+
+            prompts = []
+            for init_prompt_msg, messages in conversations:
+                submit_messages = [{'role':'system','message':init_prompt_msg,'current_date':get_current_time()}] + messages
+                submit_messages, _ = self._fit_context_window(point_config_dict, submit_messages)
+                with self._span('serialization', model=model, messages=len(submit_messages)):
+                    prompt = self._messages_to_oai_messages(submit_messages, messages) if is_chat_model else self._messages_to_oai_prompt_str(submit_messages, messages)
+                prompts.append((prompt, self.token_counter.count_messages(model, submit_messages, self._separator_tokens(model))))
+
+            # as many samples per request as the largest prompt leaves room for 
+            largest_prompt_tokens = max(prompt_tokens for _, prompt_tokens in prompts)
+            samples_per_request = max(1, min(samples, MAX_SAMPLES_PER_REQUEST, (tokens_per_request - largest_prompt_tokens) // max_tokens))
+            sample_counts = [min(samples_per_request, samples - start) for start in range(0, samples, samples_per_request)]
+
+            for n in sample_counts:
+                if is_chat_model:
+                    batches = [[index] for index in range(len(prompts))]
+                else:
+                    batches = self._batch_prompts([prompt_tokens + n * max_tokens for _, prompt_tokens in prompts], tokens_per_request)
+
+                for batch in batches:
+                    params = {**self._sampling_params(point_config_dict), 'n': n}
+                    if is_chat_model:
+                        params['messages'] = prompts[batch[0]][0]
+                    else:
+                        params['prompt'] = [prompts[index][0] for index in batch]
+                    resource = 'ChatCompletion' if is_chat_model else 'Completion'
+                    requests.append((point_index, batch, n, open_ai_request(resource, params=params)))
+
+        results = {(point_index, conversation_index): {'params': point, 'conversation': conversation_index, 'responses': [], 'error': None}
+                   for point_index, point in enumerate(param_grid) for conversation_index in range(len(conversations))}
+        # usage of responses served from the cache is kept apart, since it was already paid for 
+        sweep = {'results': list(results.values()), 'requests': len(requests), 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0,
+                 'cached_requests': 0, 'cached_prompt_tokens': 0, 'cached_completion_tokens': 0, 'cached_total_tokens': 0}
+        if len(requests) == 0:
+            return sweep
+
+        deadline = model_config_dict.get('deadline')
+        hedge = model_config_dict.get('hedge', False)
+        with instrumentation.call_context(), self._span('call', model=model, sweep_requests=len(requests)):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or min(len(requests), 8)) as executor:
+                futures = {
+                    executor.submit(contextvars.copy_context().run, self._invoke_cached_call, request, deadline, hedge): (point_index, batch, n)
+                    for point_index, batch, n, request in requests
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    point_index, batch, n = futures[future]
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        for conversation_index in batch:
+                            results[(point_index, conversation_index)]['error'] = str(e)
+                        continue
+
+                    # choices come back grouped by prompt: prompt i holds choices i*n to i*n + n - 1 
+                    for choice in sorted(response['choices'], key=lambda choice: choice['index']):
+                        text = choice['message']['content'] if is_chat_model else choice['text']
+                        results[(point_index, batch[choice['index'] // n])]['responses'].append(text.strip())
+                    prefix = ''
+                    if isinstance(response, cache_util.cached_response):
+                        prefix = 'cached_'
+                        sweep['requests'] -= 1
+                        sweep['cached_requests'] += 1
+                    for usage_key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+                        sweep[prefix + usage_key] += response['usage'][usage_key]
+        return sweep
+
+
+    @staticmethod
+    def _batch_prompts(prompt_costs, tokens_per_request):
+        """Packs prompts, in order, into batches that stay within the per-request token budget and prompt count"""
+        batches = [[]]
+        batch_tokens = 0
+        for index, cost in enumerate(prompt_costs):
+            if len(batches[-1]) > 0 and (batch_tokens + cost > tokens_per_request or len(batches[-1]) >= MAX_PROMPTS_PER_REQUEST):
+                batches.append([])
+                batch_tokens = 0
+            batches[-1].append(index)
+            batch_tokens += cost
+        return batches
+
+
+    def _get_chat_completion(self, model_config_dict, messages, stream=False, history_messages=None):
+        get_completion_request = self._chat_completion_request(model_config_dict, messages, stream, history_messages)
+        try:
+            completions = self._invoke_cached_call(get_completion_request, deadline=model_config_dict.get('deadline'), hedge=model_config_dict.get('hedge', False) and not stream)
             return completions
         except Exception as e:
             raise 
 
 
-    def _get_completion(self, model_config_dict, messages):
+    def _chat_completion_request(self, model_config_dict, messages, stream=False, history_messages=None):
         self._validate_model_config(model_config_dict)
-        oai_message = self._messages_to_oai_prompt_str(messages)
-
-        get_completion_call_string = (
-        """openai.Completion.create(
-            model="{0}",
-            prompt="{1}",
-            temperature={2},
-            max_tokens={3},
-            top_p={4},
-            frequency_penalty={5},
-            presence_penalty={6},
-            stop=['{7}']
-            )""").format(
-                model_config_dict['model'],
-                oai_message,
-                model_config_dict['temperature'],
-                model_config_dict['max_tokens'],
-                model_config_dict['top_p'],
-                model_config_dict['frequency_penalty'],
-                model_config_dict['presence_penalty'],
-                self.stop_sequence
-            )            
-        
+        with self._span('serialization', model=model_config_dict['model'], messages=len(messages)):
+            oai_messages = self._messages_to_oai_messages(messages, history_messages)
+
+        return open_ai_request('ChatCompletion', params={
+            **self._sampling_params(model_config_dict),
+            'messages': oai_messages,
+            'stream': stream
+        })
+
+
+    def _get_completion(self, model_config_dict, messages, stream=False, history_messages=None):
+        get_completion_request = self._completion_request(model_config_dict, messages, stream, history_messages)
         try:
-            completions = self._invoke_call(get_completion_call_string)
+            completions = self._invoke_cached_call(get_completion_request, deadline=model_config_dict.get('deadline'), hedge=model_config_dict.get('hedge', False) and not stream)
             return completions
         except Exception as e:
             raise 
 
 
+    def _completion_request(self, model_config_dict, messages, stream=False, history_messages=None):
+        self._validate_model_config(model_config_dict)
+        with self._span('serialization', model=model_config_dict['model'], messages=len(messages)):
+            oai_message = self._messages_to_oai_prompt_str(messages, history_messages)
+
+        return open_ai_request('Completion', params={
+            **self._sampling_params(model_config_dict),
+            'prompt': oai_message,
+            'stream': stream
+        })
+
+
+    def count_prompt_tokens(self, model, init_prompt_msg, messages):
+        """Counts offline the prompt tokens a request to model would send"""
+        submit_messages = [{'role':'system','message':init_prompt_msg}] + messages
+        return self.token_counter.count_messages(model, submit_messages, self._separator_tokens(model))
+
+
     # helper functions 
+    @contextlib.contextmanager
+    def _span(self, name, **attributes):
+        """Times the block and reports it to the instrumentation hooks; the yielded dict takes extra attributes"""
+        if len(self.hooks) == 0:
+            yield attributes
+            return
+
+        start = time.time()
+        start_time = time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes['outcome'] = type(e).__name__
+            raise
+        finally:
+            self._emit_span(name, start, time.perf_counter() - start_time, **attributes)
+
+
+    def _emit_span(self, name, start, duration, **attributes):
+        if len(self.hooks) == 0:
+            return
+        span = {'name':name, 'call_id':instrumentation.current_call_id.get(), 'start':start, 'duration':duration, 'outcome':'ok', **attributes}
+        for hook in self.hooks:
+            try:
+                hook(span)
+            except Exception as e:
+                logging.error(f"Instrumentation hook failed: {e}")
+
+
+    def _fit_context_window(self, model_config_dict, submit_messages):
+        """Trims the oldest messages so the request fits the model's context window, when one is configured"""
+        if 'context_window' not in model_config_dict:
+            return submit_messages, 0
+
+        return self.token_counter.trim_messages(
+            model_config_dict['model'], 
+            submit_messages, 
+            context_window=model_config_dict['context_window'], 
+            max_tokens=model_config_dict['max_tokens'], 
+            policy=model_config_dict.get('trim_policy', 'pinned_system'),
+            separator_tokens=self._separator_tokens(model_config_dict['model'])
+        )
+
+
+    def _separator_tokens(self, model):
+        # completion prompts end every message with the stop or restart sequence 
+        return max(token_util.count_text_tokens(self.stop_sequence, model), token_util.count_text_tokens(self.restart_sequence, model))
+
+
     def _validate_model_config(self, model_config_dict):
         required_fields = ['model', 'temperature', 'max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty']
 
@@ -187,22 +867,68 @@ class open_ai:
         return True
 
 
-    def _messages_to_oai_prompt_str(self, messages):
-        msg_string = ""
-        for message in messages:
-            if message['role'] == 'user' or message['role'] == 'system':
-                msg_string += escape_special_chars(message['message']) + self.stop_sequence
-            else:
-                msg_string += escape_special_chars(message['message']) + self.restart_sequence
-        return msg_string
+    def _sampling_params(self, model_config_dict):
+        return {
+            'model': model_config_dict['model'],
+            'temperature': model_config_dict['temperature'],
+            'max_tokens': model_config_dict['max_tokens'],
+            'top_p': model_config_dict['top_p'],
+            'frequency_penalty': model_config_dict['frequency_penalty'],
+            'presence_penalty': model_config_dict['presence_penalty'],
+            'stop': [self.stop_sequence]
+        }
 
 
-    def _messages_to_oai_messages(self, messages):
-        oai_messages = []
-        if len(messages) > 0:
-            for message in messages:
-                oai_messages.append({'role':message['role'], 'content':escape_special_chars(message['message'])})
-        return oai_messages 
+    def _messages_to_oai_prompt_str(self, messages, history_messages=None):
+        """The completion prompt of messages, the system prompt and a window of history_messages as trimmed for the request"""
+        system_messages, window = self._split_system_message(messages)
+        system_prompt = ''.join(message['message'] + self.stop_sequence for message in system_messages)
+        if len(window) == 0:
+            return system_prompt
 
+        with self._extended_history(window, history_messages) as history:
+            return system_prompt + history.prompt_window(len(window))
 
 
+    def _messages_to_oai_messages(self, messages, history_messages=None):
+        """The chat messages of messages, the system prompt and a window of history_messages as trimmed for the request"""
+        system_messages, window = self._split_system_message(messages)
+        oai_system_messages = [{'role':message['role'], 'content':message['message']} for message in system_messages]
+        if len(window) == 0:
+            return oai_system_messages
+
+        with self._extended_history(window, history_messages) as history:
+            return oai_system_messages + history.oai_messages_window(len(window))
+
+
+    def _split_system_message(self, messages):
+        # the system prompt is rebuilt for every request, so it is encoded separately from the cached history 
+        if len(messages) > 0 and messages[0]['role'] == 'system':
+            return messages[:1], messages[1:]
+        return [], messages
+
+
+    @contextlib.contextmanager
+    def _extended_history(self, window, history_messages):
+        """Yields the locked, up to date encodings of history_messages, the untrimmed history that window is the tail of"""
+        if history_messages is None or len(window) > len(history_messages) or window[-1] is not history_messages[-1]:
+            # with no history list to key on, the window is encoded on its own 
+            history = serialized_history(self.stop_sequence, self.restart_sequence)
+            history_messages = window
+        else:
+            history = self._serialized_history(history_messages)
+
+        with history.lock:
+            history.extend(history_messages)
+            yield history
+
+
+    def _serialized_history(self, history_messages):
+        """Returns the cached encodings of a conversation, by the history list that it grows in"""
+        # the entry keeps a reference to the list, so its id is not reused while the entry lives 
+        key = (id(history_messages), self.stop_sequence, self.restart_sequence)
+        with _serialized_histories_lock:
+            entry = _serialized_histories.get(key)
+            if entry is None or entry[0] is not history_messages:
+                entry = _serialized_histories[key] = (history_messages, serialized_history(self.stop_sequence, self.restart_sequence))
+        return entry[1]
@@ -0,0 +1,241 @@
+"""Headless batch evaluation: runs every prompt x model x parameter set of a JSONL suite.
+
+Each suite line is a JSON object with an initial prompt and, optionally, follow-up messages:
+
+    {"id": "greeting", "prompt": "You are a friendly assistant.", "messages": ["Hi there!"]}
+
+Results are appended to a JSONL file as they finish, so an interrupted run can be restarted with the
+same arguments and only redoes the items that have not completed.
+
+    python batch_eval.py suite.jsonl results.jsonl --models gpt-3.5-turbo text-davinci-003 --param-set '{"temperature": 0}'
+
+Add --estimate to print the most the pending items could cost without calling any model.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import time
+import api_util as api
+import instrumentation
+import model_registry
+import pricing
+
+
+DEFAULT_PARAMS = {'max_tokens': 300, 'temperature': 0.7, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0}
+# columns of the Parquet export, so every file has them whatever its first record holds 
+RESULT_COLUMNS = (
+    ('id', 'string'), ('prompt_id', 'string'), ('model', 'string'), ('params', 'string'), ('error', 'string'), ('response', 'string'),
+    ('total_tokens', 'int64'), ('prompt_tokens', 'int64'), ('completion_tokens', 'int64'), ('cached', 'bool_'), ('latency', 'float64'),
+    ('cost', 'float64'), ('finished_at', 'string')
+)
+
+
+def load_suite(suite_path):
+    """Reads the suite's prompts. One without an id gets a hash of its prompt and messages, so it keeps its id when lines move"""
+    suite = []
+    with open(suite_path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip() == '':
+                continue
+            entry = json.loads(line)
+            if 'prompt' not in entry:
+                raise ValueError(f"{suite_path}:{line_number}: suite entries need a 'prompt'")
+            entry.setdefault('messages', [])
+            if 'id' not in entry:
+                content = json.dumps({'prompt': entry['prompt'], 'messages': entry['messages']}, sort_keys=True)
+                entry['id'] = hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]
+            suite.append(entry)
+    return suite
+
+
+def get_item_id(prompt_id, model, params):
+    params_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return f"{prompt_id}|{model}|{params_hash}"
+
+
+def load_completed_item_ids(output_path):
+    """Ids of the items that already have a successful result in the output file"""
+    completed_item_ids = set()
+    if not os.path.exists(output_path):
+        return completed_item_ids
+
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be cut short if the previous run crashed mid-write
+                continue
+            if record.get('error') is None:
+                completed_item_ids.add(record['id'])
+    return completed_item_ids
+
+
+def run_item(o, entry, model, params, deadline=None, hedge=False):
+    model_config_dict = {**DEFAULT_PARAMS, **params, 'model': model, 'deadline': deadline, 'hedge': hedge}
+    context_window = model_registry.get_context_window(model)
+    if context_window is not None:
+        model_config_dict['context_window'] = context_window
+    messages = [{'role': 'user', 'message': message, 'created_date': api.get_current_time()} for message in entry['messages']]
+
+    start_time = time.perf_counter()
+    b_r = o.get_ai_response(model_config_dict=model_config_dict, init_prompt_msg=entry['prompt'], messages=messages)
+    return {
+        'response': b_r['messages'][-1]['message'],
+        'total_tokens': b_r['total_tokens'],
+        'prompt_tokens': b_r['prompt_tokens'],
+        'completion_tokens': b_r['completion_tokens'],
+        'cached': b_r['cached'],
+        'latency': time.perf_counter() - start_time
+    }
+
+
+def truncate_partial_line(output_path):
+    """Drops a last line cut short by a crash mid-write, so appended results start on a line of their own"""
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        # the partial result never counted as completed, so its item runs again 
+        f.seek(0)
+        f.truncate(f.read().rfind(b'\n') + 1)
+
+
+def get_pending_items(suite, output_path, models, param_sets):
+    """The (item id, entry, model, params) of every item without a successful result in output_path"""
+    completed_item_ids = load_completed_item_ids(output_path)
+    items = []
+    for entry in suite:
+        for model in models:
+            for params in param_sets:
+                item_id = get_item_id(entry['id'], model, params)
+                if item_id not in completed_item_ids:
+                    items.append((item_id, entry, model, params))
+    return items
+
+
+def estimate_suite_cost(o, suite_path, output_path, models, param_sets=None, table=None):
+    """Pre-flight cost of the items still to run, counting prompt tokens offline and assuming every response uses its whole max_tokens"""
+    table = table or pricing.shared_table
+    items = get_pending_items(load_suite(suite_path), output_path, models, param_sets or [{}])
+    return table.estimate_batch(
+        [model for _, _, model, _ in items],
+        [o.count_prompt_tokens(model, entry['prompt'], [{'role': 'user', 'message': message} for message in entry['messages']]) for _, entry, model, _ in items],
+        [{**DEFAULT_PARAMS, **params}['max_tokens'] for _, _, _, params in items]
+    )
+
+
+def run_suite(o, suite_path, output_path, models, param_sets=None, concurrency=4, deadline=None, hedge=False, costs=None):
+    """Runs every prompt x model x parameter set not yet completed in output_path, and returns throughput and per-model cost stats.
+    Items that miss the deadline are recorded as errors, so a rerun tries them again."""
+    suite = load_suite(suite_path)
+    param_sets = param_sets or [{}]
+    costs = costs if costs is not None else pricing.cost_accumulator()
+    items = get_pending_items(suite, output_path, models, param_sets)
+    truncate_partial_line(output_path)
+
+    stats = {'skipped': len(suite) * len(models) * len(param_sets) - len(items), 'completed': 0, 'failed': 0, 'total_tokens': 0, 'completion_tokens': 0}
+    start_time = time.perf_counter()
+
+    with open(output_path, 'a') as output, concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(run_item, o, entry, model, params, deadline, hedge): (item_id, entry, model, params) for item_id, entry, model, params in items}
+
+        for future in concurrent.futures.as_completed(futures):
+            item_id, entry, model, params = futures[future]
+            record = {'id': item_id, 'prompt_id': entry['id'], 'model': model, 'params': params, 'error': None}
+            try:
+                result = future.result()
+                result['cost'] = costs.record(model, result['prompt_tokens'], result['completion_tokens'], suite=suite_path, cached=result['cached'])
+                record.update(result)
+                stats['completed'] += 1
+                stats['total_tokens'] += result['total_tokens']
+                stats['completion_tokens'] += result['completion_tokens']
+            except Exception as e:
+                logging.error(f"{item_id}: {e}")
+                record['error'] = str(e)
+                stats['failed'] += 1
+
+            record['finished_at'] = api.get_current_time().isoformat()
+            # one line per result, flushed right away so a crash loses at most the items in flight
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+
+    elapsed = time.perf_counter() - start_time
+    stats['elapsed'] = elapsed
+    stats['requests_per_sec'] = (stats['completed'] + stats['failed']) / elapsed if elapsed > 0 else 0.0
+    stats['tokens_per_sec'] = stats['total_tokens'] / elapsed if elapsed > 0 else 0.0
+    stats['completion_tokens_per_sec'] = stats['completion_tokens'] / elapsed if elapsed > 0 else 0.0
+    stats['costs'] = costs.aggregate(by='model', where={'suite': suite_path})
+    return stats
+
+
+def write_parquet(output_path, parquet_path):
+    """Converts the JSONL results to Parquet"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    records = []
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by a crash, as in load_completed_item_ids
+                continue
+            record['params'] = json.dumps(record['params'], sort_keys=True)
+            records.append(record)
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in RESULT_COLUMNS])
+    pq.write_table(pa.Table.from_pylist(records, schema=schema), parquet_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('suite', help="JSONL prompt suite")
+    parser.add_argument('output', help="JSONL results file; existing successful results are not redone")
+    parser.add_argument('--models', nargs='+', default=list(model_registry.MODEL_CAPABILITIES), help="Models to run")
+    parser.add_argument('--param-set', action='append', type=json.loads, dest='param_sets', help="JSON object of sampling parameters; repeat for a sweep")
+    parser.add_argument('--concurrency', type=int, default=4, help="Requests in flight at once")
+    parser.add_argument('--deadline', type=float, help="Seconds to wait for each response before recording it as timed out")
+    parser.add_argument('--hedge', action='store_true', help="Resend requests slower than the model's observed p95 and keep the first answer")
+    parser.add_argument('--hedge-budget', type=float, default=1.0, help="Cap on the estimated $ spent on hedged duplicates")
+    parser.add_argument('--pricing', help="JSON pricing table to use instead of pricing.json")
+    parser.add_argument('--estimate', action='store_true', help="Only print the most the pending items could cost, without running them")
+    parser.add_argument('--parquet', help="Also write the results to this Parquet file when done")
+    parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY'), help="OpenAI API key (default: $OPENAI_API_KEY)")
+    args = parser.parse_args()
+
+    # the estimate counts tokens offline, so it needs no key 
+    if not args.api_key and not args.estimate:
+        parser.error("an API key is required, via --api-key or OPENAI_API_KEY")
+
+    o = api.open_ai(
+        api_key=args.api_key, restart_sequence='|UR|', stop_sequence='|SP|', pool=api.connection_pool(pool_size=args.concurrency),
+        latency_store=instrumentation.histogram_store(), hedge_budget=api.hedge_budget(max_extra_cost=args.hedge_budget) if args.hedge else None
+    )
+    table = pricing.load_pricing_table(args.pricing) if args.pricing else pricing.shared_table
+    if args.estimate:
+        estimate = estimate_suite_cost(o, args.suite, args.output, args.models, args.param_sets, table)
+        print(f"{estimate['calls']} calls pending, up to ${estimate['total']:.4f}")
+        for model, cost in estimate['by_model'].items():
+            print(f"  {model}: up to ${cost:.4f}")
+        raise SystemExit(0)
+
+    stats = run_suite(o, args.suite, args.output, args.models, args.param_sets, args.concurrency, args.deadline, args.hedge, pricing.cost_accumulator(table))
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
+
+    print(f"{stats['completed']} completed, {stats['failed']} failed, {stats['skipped']} already done in {stats['elapsed']:.1f}s")
+    print(f"{stats['requests_per_sec']:.2f} requests/s, {stats['tokens_per_sec']:.1f} tokens/s ({stats['completion_tokens_per_sec']:.1f} completion tokens/s)")
+    for row in stats['costs']:
+        print(f"  {row['model']}: ${row['cost']:.4f} over {row['calls']} calls, mean ${row['mean_cost']:.5f}, p95 ${row['p95_cost']:.5f}")
+    if o.hedge_budget is not None and o.hedge_budget.hedges > 0:
+        # abandoned duplicates never report their usage, so only the budget's upper bound is known 
+        print(f"  plus up to ${o.hedge_budget.spent:.4f} on {o.hedge_budget.hedges} hedged duplicates, not included above")
@@ -0,0 +1,431 @@
+"""Benchmarks for the OpenAI call path: offline microbenchmarks and load tests against mock_openai. Run with `python benchmark.py <benchmark>`"""
+import argparse
+import concurrent.futures
+import contextlib
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import types
+import api_util as api
+import conversation_store
+import instrumentation
+import mock_openai
+import pricing
+import random
+
+
+def _stub_openai():
+    """An offline stand-in for the openai module that returns the call kwargs instead of hitting the network"""
+    def _echo(**kwargs):
+        return kwargs
+
+    return types.SimpleNamespace(
+        error=api._import_openai().error,
+        api_requestor=api._import_openai().api_requestor,
+        ChatCompletion=types.SimpleNamespace(create=_echo),
+        Completion=types.SimpleNamespace(create=_echo),
+        Moderation=types.SimpleNamespace(create=_echo),
+        Model=types.SimpleNamespace(list=_echo)
+    )
+
+
+@contextlib.contextmanager
+def stubbed_openai():
+    # api_util imports openai on first use, so the stub stands in for that import 
+    real_import_openai = api._import_openai
+    stub = _stub_openai()
+    api._import_openai = lambda: stub
+    try:
+        yield stub
+    finally:
+        api._import_openai = real_import_openai
+
+
+def _sample_history(turns):
+    messages = [{'role':'system', 'message':"You are a helpful assistant.\nAnswer 'briefly'.", 'current_date':None}]
+    for i in range(turns - 1):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        messages.append({'role':role, 'message':f'Message {i}: "quoted" text,\ta tab and a \\backslash.\nSecond line.', 'created_date':None})
+    return messages
+
+
+def _legacy_escape_special_chars(text):
+    return (
+        text.replace("\\", "\\\\")
+        .replace("\"", "\\\"")
+        .replace("'", "\\'")
+        .replace("\n", "\\n")
+        .replace("\t", "\\t")
+        .replace("\r", "\\r")
+    )
+
+
+def _legacy_chat_completion(stub, o, model_config_dict, messages):
+    """The pre-request-object call path: serialize the call to source text and eval it"""
+    oai_messages = [{'role':message['role'], 'content':_legacy_escape_special_chars(message['message'])} for message in messages]
+    call_string = (
+    """openai.ChatCompletion.create(
+        model="{0}",
+        messages={1},
+        temperature={2},
+        max_tokens={3},
+        top_p={4},
+        frequency_penalty={5},
+        presence_penalty={6},
+        stop=['{7}']
+        )""").format(
+            model_config_dict['model'],
+            oai_messages,
+            model_config_dict['temperature'],
+            model_config_dict['max_tokens'],
+            model_config_dict['top_p'],
+            model_config_dict['frequency_penalty'],
+            model_config_dict['presence_penalty'],
+            o.stop_sequence
+        )
+    return eval(call_string, {'openai': stub})
+
+
+def bench_request_build(sizes=(10, 100, 1000), repeat=5):
+    """Per-call overhead of building and dispatching a chat request, eval path vs structured request"""
+    o = api.open_ai(api_key='sk-benchmark', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None)
+    model_config_dict = {'model':'gpt-3.5-turbo', 'temperature':0.7, 'max_tokens':300, 'top_p':1.0, 'frequency_penalty':0.0, 'presence_penalty':0.0}
+
+    print(f"{'messages':>10} {'eval (us)':>12} {'request (us)':>14} {'speedup':>9}")
+    with stubbed_openai() as stub:
+        for size in sizes:
+            messages = _sample_history(size)
+            number = max(1, 2000 // size)
+            legacy = min(timeit.repeat(lambda: _legacy_chat_completion(stub, o, model_config_dict, messages), number=number, repeat=repeat)) / number
+            current = min(timeit.repeat(lambda: o._get_chat_completion(model_config_dict, messages, history_messages=messages), number=number, repeat=repeat)) / number
+            print(f"{size:>10} {legacy * 1e6:>12.1f} {current * 1e6:>14.1f} {legacy / current:>8.1f}x")
+
+
+def _rebuilt_prompt_str(o, messages):
+    """The pre-incremental completion path: concatenate the whole history on every turn"""
+    msg_string = ""
+    for message in messages:
+        if message['role'] == 'user' or message['role'] == 'system':
+            msg_string += message['message'] + o.stop_sequence
+        else:
+            msg_string += message['message'] + o.restart_sequence
+    return msg_string
+
+
+def _rebuilt_oai_messages(o, messages):
+    """The pre-incremental chat path: re-encode every message on every turn"""
+    oai_messages = []
+    for message in messages:
+        oai_messages.append({'role':message['role'], 'content':message['message']})
+    return oai_messages
+
+
+def bench_history_serialization(turns=500, repeat=3):
+    """Cumulative serialization cost of a whole conversation, rebuilt every turn vs incremental"""
+    o = api.open_ai(api_key='sk-benchmark', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None)
+    history = _sample_history(2 * turns + 1)[1:]
+
+    def run_conversation(serialize):
+        # like the conversation store, the conversation grows in place in one list 
+        conversation = []
+        for turn in range(1, turns + 1):
+            system_message = {'role':'system', 'message':"You are a helpful assistant.", 'current_date':None}
+            conversation.extend(history[2 * turn - 2:2 * turn])
+            serialize([system_message] + conversation, conversation)
+
+    paths = [
+        ('completion', lambda messages, conversation=None: _rebuilt_prompt_str(o, messages), o._messages_to_oai_prompt_str),
+        ('chat', lambda messages, conversation=None: _rebuilt_oai_messages(o, messages), o._messages_to_oai_messages)
+    ]
+
+    print(f"{'path':>12} {'turns':>6} {'rebuilt (ms)':>13} {'incremental (ms)':>17} {'speedup':>9}")
+    for name, rebuilt, incremental in paths:
+        assert rebuilt([history[0]] + history[:4]) == incremental([history[0]] + history[:4], history[:4])
+        before = min(timeit.repeat(lambda: run_conversation(rebuilt), number=1, repeat=repeat))
+        # a fresh conversation per repeat, so the incremental path starts from an empty cache 
+        after = min(timeit.repeat(lambda: run_conversation(incremental), setup=api._serialized_histories.clear, number=1, repeat=repeat))
+        print(f"{name:>12} {turns:>6} {before * 1e3:>13.1f} {after * 1e3:>17.1f} {before / after:>8.1f}x")
+
+
+def _load_test(run_one, concurrency, requests):
+    """Runs run_one requests times with the given concurrency, and returns latency percentiles and throughput"""
+    def timed_run():
+        start_time = time.perf_counter()
+        try:
+            run_one()
+            return time.perf_counter() - start_time, None
+        except Exception as e:
+            return time.perf_counter() - start_time, e
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: timed_run(), range(requests)))
+    elapsed = time.perf_counter() - start_time
+
+    latencies = [latency for latency, _ in results]
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'p50': quantiles[49], 'p95': quantiles[94], 'p99': quantiles[98],
+        'throughput': requests / elapsed,
+        'errors': sum(1 for _, error in results if error is not None)
+    }
+
+
+def _print_load_results(label, concurrency, requests, results):
+    print(f"{label:>16} {concurrency:>5} {requests:>6} {results['p50'] * 1e3:>9.1f} {results['p95'] * 1e3:>9.1f} {results['p99'] * 1e3:>9.1f} {results['throughput']:>9.1f} {results['errors']:>7}")
+
+
+def _print_load_header():
+    print(f"{'scenario':>16} {'conc':>5} {'reqs':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'req/s':>9} {'errors':>7}")
+
+
+def _mock_client(concurrency):
+    # the load tests measure our own call path against the mock server, so they bypass the shared rate limiter 
+    return api.open_ai(api_key='sk-benchmark', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None, pool=api.connection_pool(pool_size=concurrency))
+
+
+_model_config_template = {'temperature':0.7, 'max_tokens':300, 'top_p':1.0, 'frequency_penalty':0.0, 'presence_penalty':0.0}
+
+
+def bench_load_get_ai_response(levels=(1, 4, 16, 32), requests=64):
+    """get_ai_response against the mock server at increasing concurrency"""
+    messages = _sample_history(9)[1:]
+    _print_load_header()
+    with mock_openai.run_mock_server(latency=('lognormal', 0.02, 0.5), seed=0):
+        for concurrency in levels:
+            o = _mock_client(concurrency)
+            run_one = lambda: o.get_ai_response({**_model_config_template, 'model':'gpt-3.5-turbo'}, "You are a helpful assistant.", messages)
+            _print_load_results('get_ai_response', concurrency, requests, _load_test(run_one, concurrency, requests))
+
+
+def bench_load_retries(levels=(1, 4, 16), requests=48):
+    """_invoke_call retries with 429s (honouring Retry-After) and 5xx errors injected"""
+    _print_load_header()
+    with mock_openai.run_mock_server(latency=('lognormal', 0.02, 0.5), error_rate_429=0.05, error_rate_5xx=0.1, retry_after=0.05, seed=0) as server:
+        for concurrency in levels:
+            o = _mock_client(concurrency)
+            run_one = lambda: o.get_ai_response({**_model_config_template, 'model':'gpt-3.5-turbo'}, "You are a helpful assistant.", [])
+            _print_load_results('retries', concurrency, requests, _load_test(run_one, concurrency, requests))
+        print(f"injected: {server.stats['requests'].get('errors_429', 0)} x 429, {server.stats['requests'].get('errors_5xx', 0)} x 5xx")
+
+
+def bench_load_fetch_round(levels=(1, 4, 16), rounds=32):
+    """A fetch round as handler_fetch_model_responses runs it (fan-out over three models), with concurrent sessions"""
+    model_latency = {'gpt-4': ('lognormal', 0.08, 0.5), 'gpt-3.5-turbo': ('lognormal', 0.02, 0.5), 'text-davinci-003': ('lognormal', 0.04, 0.5)}
+    models = list(model_latency)
+    messages = _sample_history(9)[1:]
+    _print_load_header()
+    with mock_openai.run_mock_server(model_latency=model_latency, seed=0):
+        for concurrency in levels:
+            o = _mock_client(concurrency * len(models))
+            def run_one():
+                for m, b_r, e in o.get_ai_responses([{**_model_config_template, 'model':m} for m in models], "You are a helpful assistant.", {m: messages for m in models}):
+                    if e is not None:
+                        raise e
+            _print_load_results('fetch_round', concurrency, rounds, _load_test(run_one, concurrency, rounds))
+
+
+def bench_load_hedging(concurrency=4, requests=200, deadline=0.25):
+    """Tail latency of get_ai_response against a heavy-tailed mock model: plain, hedged at the observed p95, and with a deadline"""
+    model_config_dict = {**_model_config_template, 'model':'gpt-3.5-turbo'}
+    _print_load_header()
+    with mock_openai.run_mock_server(latency=('lognormal', 0.02, 1.0), seed=0):
+        latency_store = instrumentation.histogram_store()
+        budget = api.hedge_budget(max_extra_cost=1.0)
+        o = _mock_client(concurrency)
+        o.latency_store, o.hedge_budget = latency_store, budget
+        o.add_hook(latency_store.record)
+
+        run_one = lambda: o.get_ai_response(model_config_dict, "You are a helpful assistant.", [])
+        # the plain run also fills the latency store the hedges are timed from 
+        _print_load_results('plain', concurrency, requests, _load_test(run_one, concurrency, requests))
+
+        hedged_config = {**model_config_dict, 'hedge': True}
+        run_one = lambda: o.get_ai_response(hedged_config, "You are a helpful assistant.", [])
+        _print_load_results('hedged', concurrency, requests, _load_test(run_one, concurrency, requests))
+        print(f"hedges: {budget.hedges} ({budget.hedges / requests:.0%} of requests), estimated extra spend ${budget.spent:.4f}, p95 {latency_store.quantile('network', 0.95, model='gpt-3.5-turbo') * 1e3:.0f} ms")
+
+        deadline_config = {**model_config_dict, 'deadline': deadline}
+        run_one = lambda: o.get_ai_response(deadline_config, "You are a helpful assistant.", [])
+        _print_load_results(f'deadline {deadline}s', concurrency, requests, _load_test(run_one, concurrency, requests))
+
+
+def bench_sweep_batching(conversations=5, samples=5, temperatures=(0.0, 0.5, 1.0)):
+    """A sampling-variance sweep through get_ai_sweep's batched requests vs one get_ai_response call per sample"""
+    model_latency = {'gpt-3.5-turbo': ('lognormal', 0.02, 0.5), 'text-davinci-003': ('lognormal', 0.04, 0.5)}
+    sweep_conversations = [(f"You are assistant number {index}.", _sample_history(5)[1:]) for index in range(conversations)]
+    param_grid = [{'temperature': temperature} for temperature in temperatures]
+    print(f"{'model':>16} {'mode':>8} {'requests':>9} {'time (s)':>9}")
+    with mock_openai.run_mock_server(model_latency=model_latency, seed=0) as server:
+        for model in model_latency:
+            model_config_dict = {**_model_config_template, 'model':model}
+            o = _mock_client(8)
+
+            start_requests = server.stats['requests'].get(model, 0)
+            start_time = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(
+                    lambda job: o.get_ai_response({**model_config_dict, **job[1]}, *job[0]),
+                    [(conversation, point) for conversation in sweep_conversations for point in param_grid for _ in range(samples)]
+                ))
+            print(f"{model:>16} {'naive':>8} {server.stats['requests'][model] - start_requests:>9} {time.perf_counter() - start_time:>9.2f}")
+
+            start_requests = server.stats['requests'][model]
+            start_time = time.perf_counter()
+            o.get_ai_sweep(model_config_dict, sweep_conversations, param_grid, samples=samples, max_workers=8)
+            print(f"{model:>16} {'batched':>8} {server.stats['requests'][model] - start_requests:>9} {time.perf_counter() - start_time:>9.2f}")
+
+
+def bench_conversation_store(turns=(100, 1000, 5000), models=('gpt-4', 'gpt-3.5-turbo', 'text-davinci-003')):
+    """Appending a round to a test, and reading its latest page and (cold) full history, as the test grows"""
+    print(f"{'turns':>6} {'append round (ms)':>18} {'latest page (ms)':>17} {'cold history (ms)':>18}")
+    with tempfile.TemporaryDirectory() as directory:
+        store = conversation_store.conversation_store(os.path.join(directory, 'bench.sqlite3'))
+        for turn_count in turns:
+            test_id = store.create_test(models)
+            created_date = api.get_current_time()
+
+            start_time = time.perf_counter()
+            for index in range(turn_count):
+                store.append_user_turn(test_id, f"user message {index}", created_date)
+                for model in models:
+                    store.append_model_turn(test_id, model, f"{model} response {index}", created_date, {'total_tokens': 100, 'prompt_tokens': 80, 'completion_tokens': 20, 'cost': 0.001})
+            append_time = (time.perf_counter() - start_time) / turn_count
+
+            page_time = timeit.timeit(lambda: store.get_page(test_id, models[0]), number=20) / 20
+            # a cold read, as after a restart or once the history has left the in-process cache 
+            history_time = timeit.timeit(lambda: (store._histories.clear(), store.get_messages(test_id, models[0])), number=3) / 3
+            print(f"{turn_count:>6} {append_time * 1e3:>18.3f} {page_time * 1e3:>17.3f} {history_time * 1e3:>18.2f}")
+        store.close()
+
+
+def bench_rerun_latency(turns=(10, 50, 200), reruns=5):
+    """Streamlit rerun time of the app after a slider move, with growing histories: windowed transcripts vs every message.
+    Needs Streamlit 1.28+ for AppTest, newer than the version requirements.txt pins."""
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        import streamlit
+        print(f"skipped: AppTest needs Streamlit 1.28 or later, and {streamlit.__version__} is installed")
+        return
+
+    models = ['gpt-4', 'gpt-3.5-turbo', 'text-davinci-003']
+    print(f"{'turns':>6} {'windowed (ms)':>14} {'all messages (ms)':>18}")
+    with tempfile.TemporaryDirectory() as directory, stubbed_openai() as stub:
+        db_path = os.path.join(directory, 'bench.sqlite3')
+        os.environ['MODEL_COMPARE_DB_PATH'] = db_path
+        stub.Model.list = lambda **kwargs: {'data': [{'id': model} for model in models]}
+        store = conversation_store.conversation_store(db_path)
+
+        for turn_count in turns:
+            test_id = store.create_test(models, "You are a helpful assistant.")
+            for index in range(turn_count):
+                store.append_user_turn(test_id, f"User message {index} with a little **markdown** in it", api.get_current_time())
+                for model in models:
+                    store.append_model_turn(test_id, model, f"Response {index} from {model}:\n\n- a list item\n- another one", api.get_current_time())
+
+            timings = []
+            for history_pages in (1, turn_count):
+                at = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_compare.py'), default_timeout=60).run()
+                at.text_input(key='open_ai_key_input').input('sk-benchmark').run()
+                at.text_input(key='reload_test_id').input(test_id).run()
+                [button for button in at.button if button.label == "Reload Test"][0].click().run()
+                at.session_state['history_pages'] = history_pages
+
+                start_time = time.perf_counter()
+                for index in range(reruns):
+                    at.slider(key='model_temperature').set_value(index / 10).run()
+                timings.append((time.perf_counter() - start_time) / reruns)
+            print(f"{turn_count:>6} {timings[0] * 1e3:>14.1f} {timings[1] * 1e3:>18.1f}")
+        del os.environ['MODEL_COMPARE_DB_PATH']
+
+
+def _python_aggregate(calls, table):
+    # the per-call loop the accumulator replaces: a cost and a running total per model, then sorted percentiles 
+    by_model = {}
+    for model, prompt_tokens, completion_tokens in calls:
+        by_model.setdefault(model, []).append(table.cost(model, prompt_tokens, completion_tokens))
+    rows = []
+    for model, costs in by_model.items():
+        costs.sort()
+        rows.append({'model': model, 'calls': len(costs), 'cost': sum(costs), 'p50_cost': costs[len(costs) // 2], 'p95_cost': costs[int(len(costs) * 0.95)]})
+    return rows
+
+
+def bench_cost_aggregation(sizes=(1000, 10000, 50000), models=('gpt-4', 'gpt-3.5-turbo', 'text-davinci-003')):
+    """Recording a batch run's calls and summarizing their cost by model: NumPy columns vs a pure-Python loop"""
+    print(f"{'calls':>6} {'record (ms)':>12} {'aggregate (ms)':>15} {'python loop (ms)':>17}")
+    generator = random.Random(0)
+    for size in sizes:
+        calls = [(generator.choice(models), generator.randint(50, 3000), generator.randint(1, 500)) for _ in range(size)]
+        model_column, prompt_column, completion_column = (list(column) for column in zip(*calls))
+
+        accumulator = pricing.cost_accumulator()
+        start_time = time.perf_counter()
+        # a batch run records its results in chunks as they finish 
+        for start in range(0, size, 1000):
+            accumulator.record_many(model_column[start:start + 1000], prompt_column[start:start + 1000], completion_column[start:start + 1000], suite='bench')
+        record_time = time.perf_counter() - start_time
+
+        aggregate_time = timeit.timeit(lambda: accumulator.aggregate(by='model'), number=5) / 5
+        python_time = timeit.timeit(lambda: _python_aggregate(calls, pricing.shared_table), number=5) / 5
+        print(f"{size:>6} {record_time * 1e3:>12.2f} {aggregate_time * 1e3:>15.2f} {python_time * 1e3:>17.2f}")
+
+
+# cold-start import budgets, in ms: the modules the app script imports once Streamlit is loaded, and the batch runner 
+IMPORT_BUDGETS = {'app': 150, 'batch_eval': 200}
+_import_entries = {
+    'app': (['streamlit'], ['api_util', 'cache_util', 'rate_limit', 'model_registry', 'instrumentation', 'conversation_store', 'pricing']),
+    'batch_eval': ([], ['batch_eval'])
+}
+
+
+def _import_time(modules, preloaded=(), runs=5):
+    """Best-of-runs time to import modules in a fresh interpreter, from python -X importtime, and whether openai got imported"""
+    code = '; '.join(f'import {module}' for module in [*preloaded, *modules]) + "; import sys; print('openai' in sys.modules)"
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        # lines are "import time: self | cumulative | name", with nested imports indented under the module that imported them 
+        top_level = [line.split('|') for line in result.stderr.splitlines() if line.startswith('import time:') and '|' in line]
+        timings.append(sum(int(cumulative) for _, cumulative, name in top_level if name.strip() in modules and not name.startswith('  ')))
+    return min(timings) / 1e6, result.stdout.strip() == 'True'
+
+
+def bench_cold_start(runs=5):
+    """Import time of each entry point in a fresh interpreter, against its budget; the openai client should only load on first use"""
+    print(f"{'entry':>12} {'import (ms)':>12} {'budget (ms)':>12} {'openai loaded':>14} {'status':>7}")
+    for entry, (preloaded, modules) in _import_entries.items():
+        import_time, openai_loaded = _import_time(modules, preloaded, runs)
+        status = 'ok' if import_time * 1e3 <= IMPORT_BUDGETS[entry] and not openai_loaded else 'OVER'
+        print(f"{entry:>12} {import_time * 1e3:>12.1f} {IMPORT_BUDGETS[entry]:>12} {str(openai_loaded):>14} {status:>7}")
+
+
+BENCHMARKS = {
+    'request_build': bench_request_build,
+    'history_serialization': bench_history_serialization,
+    'load_get_ai_response': bench_load_get_ai_response,
+    'load_retries': bench_load_retries,
+    'load_fetch_round': bench_load_fetch_round,
+    'load_hedging': bench_load_hedging,
+    'sweep_batching': bench_sweep_batching,
+    'conversation_store': bench_conversation_store,
+    'rerun_latency': bench_rerun_latency,
+    'cost_aggregation': bench_cost_aggregation,
+    'cold_start': bench_cold_start
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', nargs='?', choices=sorted(BENCHMARKS), help="Benchmark to run (default: all)")
+    args = parser.parse_args()
+
+    for name, benchmark in BENCHMARKS.items():
+        if args.benchmark in (None, name):
+            print(f"## {name}")
+            benchmark()
@@ -0,0 +1,109 @@
+import cachetools
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class cached_response(dict):
+    """A model response that was served from the cache"""
+    pass
+
+
+class response_cache:
+    """Two-tier cache for model responses: an in-process LRU and an optional on-disk SQLite store with a size cap and TTL"""
+
+    def __init__(self, max_entries=256, db_path=None, max_db_bytes=50 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.lru = cachetools.LRUCache(maxsize=max_entries)
+        self.db_path = db_path
+        self.max_db_bytes = max_db_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._db.commit()
+
+
+    @staticmethod
+    def make_key(namespace, resource, params):
+        """Canonical hash of a request: the same resource and parameters always map to the same key"""
+        canonical = json.dumps({'namespace':namespace, 'resource':resource, 'params':params}, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+    def get(self, key):
+        """Returns the cached response for key, or None on a miss"""
+        with self._lock:
+            value = self.lru.get(key)
+            if value is None and self._db is not None:
+                value = self._db_get(key)
+                if value is not None:
+                    self.lru[key] = value
+
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.bytes_saved += len(value)
+            return cached_response(json.loads(value))
+
+
+    def set(self, key, response):
+        value = json.dumps(response)
+        with self._lock:
+            self.lru[key] = value
+            if self._db is not None:
+                self._db_set(key, value)
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'bytes_saved': self.bytes_saved,
+            'entries': len(self.lru)
+        }
+
+
+    # helper functions
+    def _db_get(self, key):
+        now = time.time()
+        row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and now - row[1] > self.ttl:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+            return None
+
+        self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self._db.commit()
+        return row[0]
+
+
+    def _db_set(self, key, value):
+        now = time.time()
+        self._db.execute("INSERT OR REPLACE INTO responses (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)", (key, value, len(value), now, now))
+
+        # drop expired entries, then the least recently used ones until the store fits its size cap
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total_bytes > self.max_db_bytes:
+            row = self._db.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            total_bytes -= row[1]
+        self._db.commit()
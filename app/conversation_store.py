@@ -0,0 +1,150 @@
+import cachetools
+import datetime
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class conversation_store:
+    """Chat histories of model comparison tests, in SQLite (WAL mode) rather than in session state.
+    Turns are append-only, and a user turn is stored once and shared by every model of the test.
+    Recently used histories stay loaded in a bounded in-process cache, so a growing conversation only reads its new turns."""
+
+    def __init__(self, db_path, max_cached_histories=64, page_size=20):
+        self.db_path = db_path
+        self.page_size = page_size
+        self._histories = cachetools.LRUCache(maxsize=max_cached_histories)
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # WAL lets readers carry on while a turn is being written; NORMAL sync is durable across app crashes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # a test belongs to the API key that started it, kept as a hash 
+        self._db.execute("CREATE TABLE IF NOT EXISTS tests (test_id TEXT PRIMARY KEY, models TEXT NOT NULL, init_prompt TEXT NOT NULL, created REAL NOT NULL, api_key_hash TEXT)")
+        if 'api_key_hash' not in [row[1] for row in self._db.execute("PRAGMA table_info(tests)")]:
+            self._db.execute("ALTER TABLE tests ADD COLUMN api_key_hash TEXT")
+        # user turns have no model; they belong to every model of the test
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS turns (turn_id INTEGER PRIMARY KEY AUTOINCREMENT, test_id TEXT NOT NULL, model TEXT, role TEXT NOT NULL, "
+            "message TEXT NOT NULL, created_date TEXT NOT NULL, prompt_tokens INTEGER, completion_tokens INTEGER, total_tokens INTEGER, cost REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS turns_test ON turns (test_id, turn_id)")
+        self._db.commit()
+
+
+    def create_test(self, models, init_prompt='', api_key_hash=None):
+        """Starts a new test for models, owned by the key with api_key_hash, and returns its id"""
+        test_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO tests (test_id, models, init_prompt, created, api_key_hash) VALUES (?, ?, ?, ?, ?)",
+                (test_id, json.dumps(list(models)), init_prompt, time.time(), api_key_hash)
+            )
+            self._db.commit()
+        return test_id
+
+
+    def get_test(self, test_id):
+        """The test's models, latest initial prompt and owning key hash, or None if there is no such test"""
+        with self._lock:
+            row = self._db.execute("SELECT models, init_prompt, created, api_key_hash FROM tests WHERE test_id = ?", (test_id,)).fetchone()
+        if row is None:
+            return None
+        return {'test_id': test_id, 'models': json.loads(row[0]), 'init_prompt': row[1], 'created': row[2], 'api_key_hash': row[3]}
+
+
+    def set_init_prompt(self, test_id, init_prompt):
+        with self._lock:
+            self._db.execute("UPDATE tests SET init_prompt = ? WHERE test_id = ?", (init_prompt, test_id))
+            self._db.commit()
+
+
+    def append_user_turn(self, test_id, message, created_date):
+        """Stores a user message once for every model of the test, and returns it as a history message"""
+        with self._lock:
+            turn = self._insert_turn(test_id, None, 'user', message, created_date)
+            for key in [key for key in self._histories.keys() if key[0] == test_id]:
+                self._histories[key].append(turn)
+        return turn
+
+
+    def append_model_turn(self, test_id, model, message, created_date, usage=None):
+        """Stores a model's response with its token usage and cost ({'prompt_tokens', 'completion_tokens', 'total_tokens', 'cost'})"""
+        with self._lock:
+            turn = self._insert_turn(test_id, model, 'assistant', message, created_date, usage)
+            history = self._histories.get((test_id, model))
+            if history is not None:
+                history.append(turn)
+        return turn
+
+
+    def get_messages(self, test_id, model):
+        """The model's whole history. The list is shared with other callers and must not be modified"""
+        with self._lock:
+            history = self._histories.get((test_id, model))
+            if history is None:
+                rows = self._db.execute(
+                    "SELECT turn_id, role, message, created_date FROM turns WHERE test_id = ? AND (model IS NULL OR model = ?) ORDER BY turn_id",
+                    (test_id, model)
+                ).fetchall()
+                history = self._histories[(test_id, model)] = [self._row_to_message(row) for row in rows]
+            return history
+
+
+    def get_page(self, test_id, model, before_turn_id=None, limit=None):
+        """The latest `limit` messages of the model's history older than before_turn_id, oldest first, and whether there are more"""
+        limit = limit or self.page_size
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT turn_id, role, message, created_date FROM turns WHERE test_id = ? AND (model IS NULL OR model = ?) AND turn_id < ? ORDER BY turn_id DESC LIMIT ?",
+                (test_id, model, before_turn_id if before_turn_id is not None else 2 ** 63 - 1, limit + 1)
+            ).fetchall()
+        has_more = len(rows) > limit
+        return [self._row_to_message(row) for row in reversed(rows[:limit])], has_more
+
+
+    def count_turns(self, test_id, model=None):
+        with self._lock:
+            if model is None:
+                return self._db.execute("SELECT COUNT(*) FROM turns WHERE test_id = ?", (test_id,)).fetchone()[0]
+            return self._db.execute("SELECT COUNT(*) FROM turns WHERE test_id = ? AND (model IS NULL OR model = ?)", (test_id, model)).fetchone()[0]
+
+
+    def get_usage(self, test_id):
+        """Token usage and cost of each model's latest response in the test, and the total cost of all its responses"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT model, prompt_tokens, completion_tokens, total_tokens, cost FROM turns WHERE turn_id IN "
+                "(SELECT MAX(turn_id) FROM turns WHERE test_id = ? AND model IS NOT NULL GROUP BY model)",
+                (test_id,)
+            ).fetchall()
+            total_costs = dict(self._db.execute("SELECT model, SUM(cost) FROM turns WHERE test_id = ? AND model IS NOT NULL GROUP BY model", (test_id,)).fetchall())
+        return {
+            row[0]: {'prompt_tokens': row[1] or 0, 'completion_tokens': row[2] or 0, 'total_tokens': row[3] or 0, 'cost': row[4] or 0.0, 'total_cost': total_costs.get(row[0]) or 0.0}
+            for row in rows
+        }
+
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+    # helper functions
+    def _insert_turn(self, test_id, model, role, message, created_date, usage=None):
+        usage = usage or {}
+        created_date = created_date.isoformat()
+        cursor = self._db.execute(
+            "INSERT INTO turns (test_id, model, role, message, created_date, prompt_tokens, completion_tokens, total_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (test_id, model, role, message, created_date, usage.get('prompt_tokens'), usage.get('completion_tokens'), usage.get('total_tokens'), usage.get('cost'))
+        )
+        self._db.commit()
+        return self._row_to_message((cursor.lastrowid, role, message, created_date))
+
+
+    def _row_to_message(self, row):
+        turn_id, role, message, created_date = row
+        return {'role': role, 'message': message, 'created_date': datetime.datetime.fromisoformat(created_date), 'turn_id': turn_id}
@@ -0,0 +1,148 @@
+import bisect
+import collections
+import contextlib
+import contextvars
+import json
+import threading
+import uuid
+
+
+# span durations in seconds, from in-process work up to slow completions
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SPAN_NAMES = ('call', 'moderation', 'serialization', 'rate_limit_wait', 'network', 'retry_sleep', 'parsing', 'stream', 'hedge')
+
+# ties the spans of one model call together, across the helpers it goes through
+current_call_id = contextvars.ContextVar('current_call_id', default=None)
+
+
+@contextlib.contextmanager
+def call_context():
+    """Starts a new call id for the spans recorded inside the block, unless one is already active"""
+    if current_call_id.get() is not None:
+        yield current_call_id.get()
+        return
+    token = current_call_id.set(uuid.uuid4().hex)
+    try:
+        yield current_call_id.get()
+    finally:
+        current_call_id.reset(token)
+
+
+class histogram_store:
+    """In-memory latency histograms per (span, model, outcome), plus the most recent raw spans"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_spans=10000):
+        self.buckets = buckets
+        self.spans = collections.deque(maxlen=max_spans)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, span):
+        """Instrumentation hook: adds a finished span to the histograms"""
+        key = (span['name'], span.get('model') or '', span.get('outcome') or 'ok')
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['counts'][bisect.bisect_left(self.buckets, span['duration'])] += 1
+            histogram['sum'] += span['duration']
+            histogram['count'] += 1
+            self.spans.append(span)
+
+
+    def quantile(self, name, q, model=None, min_count=1):
+        """Approximate quantile of a span's duration from the histogram buckets, or None with fewer than min_count spans"""
+        with self._lock:
+            counts = [0] * (len(self.buckets) + 1)
+            for (span_name, span_model, _), histogram in self._histograms.items():
+                if span_name == name and (model is None or span_model == model):
+                    counts = [a + b for a, b in zip(counts, histogram['counts'])]
+        total = sum(counts)
+        if total == 0 or total < min_count:
+            return None
+
+        # interpolate linearly inside the bucket the rank falls in, rather than jump to its upper bound 
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if count > 0 and cumulative + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+    def to_prometheus(self, metric='openai_span_duration_seconds'):
+        """Exports the histograms in the Prometheus text exposition format"""
+        lines = [f"# HELP {metric} Duration of OpenAI call spans.", f"# TYPE {metric} histogram"]
+        with self._lock:
+            for (name, model, outcome), histogram in sorted(self._histograms.items()):
+                labels = f'span="{name}",model="{model}",outcome="{outcome}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['counts']):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{metric}_sum{{{labels}}} {histogram["sum"]}')
+                lines.append(f'{metric}_count{{{labels}}} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+    def to_jsonl(self):
+        with self._lock:
+            return spans_to_jsonl(self.spans)
+
+
+def spans_to_jsonl(spans):
+    return ''.join(json.dumps(span, default=str) + '\n' for span in list(spans))
+
+
+def summarize_calls(spans):
+    """Per-model breakdown of where the time of each call went, averaged over calls; moderation requests are a 'moderation' row"""
+    calls = {}
+    for span in list(spans):
+        if span.get('call_id') is None:
+            continue
+        call = calls.setdefault(span['call_id'], {'model': None, 'durations': collections.Counter(), 'retries': 0, 'hedges': 0})
+        call['durations'][span['name']] += span['duration']
+        if span['name'] == 'call':
+            call['model'] = span.get('model')
+        if span['name'] == 'moderation':
+            # moderation requests have no model call around them, so they get a row of their own 
+            call['model'] = 'moderation'
+            call['durations']['call'] += span['duration']
+        if span['name'] == 'retry_sleep':
+            call['retries'] += 1
+        if span['name'] == 'hedge':
+            call['hedges'] += 1
+
+    summary = {}
+    for call in calls.values():
+        if call['model'] is None:
+            continue
+        model_summary = summary.setdefault(call['model'], {'calls': 0, 'retries': 0, 'hedges': 0, 'durations': collections.Counter()})
+        model_summary['calls'] += 1
+        model_summary['retries'] += call['retries']
+        model_summary['hedges'] += call['hedges']
+        model_summary['durations'].update(call['durations'])
+
+    rows = []
+    for model, model_summary in summary.items():
+        calls_count = model_summary['calls']
+        durations = model_summary['durations']
+        network = durations['network'] + durations['stream']
+        waiting = durations['rate_limit_wait'] + durations['retry_sleep']
+        rows.append({
+            'model': model,
+            'calls': calls_count,
+            'retries': model_summary['retries'],
+            'hedges': model_summary['hedges'],
+            'mean total (s)': round(durations['call'] / calls_count, 3),
+            'network (s)': round(network / calls_count, 3),
+            'backoff + rate limit (s)': round(waiting / calls_count, 3),
+            'our code (s)': round(max(durations['call'] - network - waiting, 0) / calls_count, 3)
+        })
+    return rows
@@ -0,0 +1,256 @@
+"""Offline stand-in for the OpenAI API, for tests and load benchmarks.
+
+Serves Model.list, ChatCompletion, Completion (including streaming) and Moderation with configurable
+latency, 429/5xx injection and usage accounting:
+
+    with run_mock_server(latency=('lognormal', 0.4, 0.5), error_rate_429=0.05) as server:
+        o.get_ai_response(...)
+        print(server.stats)
+"""
+import collections
+import contextlib
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+import openai
+import model_registry
+import token_util
+
+
+class mock_config:
+    """Behaviour of the mock server. Latencies are (distribution, *args) tuples in seconds:
+    ('fixed', s), ('uniform', low, high) or ('lognormal', median, sigma)."""
+
+    def __init__(self, latency=('fixed', 0.0), model_latency=None, token_latency=('fixed', 0.0), completion_tokens=20,
+                 error_rate_429=0.0, error_rate_5xx=0.0, retry_after=None, flagged_words=('flagged',), seed=None,
+                 models=tuple(model_registry.MODEL_CAPABILITIES)):
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.token_latency = token_latency
+        self.completion_tokens = completion_tokens
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.retry_after = retry_after
+        self.flagged_words = flagged_words
+        self.models = models
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+
+    def sample(self, distribution):
+        kind, *args = distribution
+        with self._lock:
+            if kind == 'fixed':
+                return args[0]
+            if kind == 'uniform':
+                return self.random.uniform(*args)
+            if kind == 'lognormal':
+                median, sigma = args
+                return self.random.lognormvariate(0, sigma) * median
+        raise ValueError(f"Unknown latency distribution: {kind}")
+
+
+    def roll(self, probability):
+        with self._lock:
+            return self.random.random() < probability
+
+
+class _mock_handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; with Nagle on, delayed ACKs add ~40ms to every keep-alive response 
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._count('models')
+            self._send_json(200, {'object': 'list', 'data': [{'id': model, 'object': 'model', 'owned_by': 'openai'} for model in self.server.config.models]})
+        else:
+            self._send_error(404, f"Unknown path {self.path}", 'invalid_request_error')
+
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = self.path.rstrip('/')
+        with self.server.stats_lock:
+            self.server.request_bodies.append(body)
+
+        if path.endswith('/moderations'):
+            self._count('moderations')
+            return self._moderation(body)
+        if not (path.endswith('/chat/completions') or path.endswith('/completions')):
+            return self._send_error(404, f"Unknown path {self.path}", 'invalid_request_error')
+
+        config = self.server.config
+        model = body.get('model', '')
+        self._count(model)
+        time.sleep(config.sample(config.model_latency.get(model, config.latency)))
+
+        if config.roll(config.error_rate_429):
+            self._count('errors_429')
+            return self._send_error(429, "Rate limit reached for requests", 'requests')
+        if config.roll(config.error_rate_5xx):
+            self._count('errors_5xx')
+            return self._send_error(500, "The server had an error while processing your request", 'server_error')
+
+        if path.endswith('/chat/completions'):
+            self._completion(body, chat=True)
+        else:
+            self._completion(body, chat=False)
+
+
+    # helper functions
+    def _completion(self, body, chat):
+        config = self.server.config
+        model = body['model']
+        if chat:
+            prompts = [''.join(message['content'] for message in body['messages'])]
+        else:
+            prompts = body['prompt'] if isinstance(body['prompt'], list) else [body['prompt']]
+        n = body.get('n', 1)
+        completion_tokens = min(config.completion_tokens, body.get('max_tokens') or config.completion_tokens)
+        prompt_tokens = sum(token_util.count_text_tokens(prompt, model) for prompt in prompts)
+
+        choices = []
+        for index in range(len(prompts) * n):
+            text = ' '.join(f"token{i}" for i in range(completion_tokens))
+            choices.append({'index': index, 'text': text, 'finish_reason': 'length'})
+
+        response_id = f"mock-{uuid.uuid4().hex}"
+        created = int(time.time())
+        object_name = 'chat.completion' if chat else 'text_completion'
+        self._add_tokens(prompt_tokens, completion_tokens * len(choices))
+
+        if body.get('stream'):
+            return self._stream(response_id, created, model, chat, choices, completion_tokens)
+
+        if chat:
+            choices = [{'index': choice['index'], 'message': {'role': 'assistant', 'content': choice['text']}, 'finish_reason': choice['finish_reason']} for choice in choices]
+        self._send_json(200, {
+            'id': response_id, 'object': object_name, 'created': created, 'model': model, 'choices': choices,
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens * len(choices), 'total_tokens': prompt_tokens + completion_tokens * len(choices)}
+        })
+
+
+    def _stream(self, response_id, created, model, chat, choices, completion_tokens):
+        config = self.server.config
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        for token_index in range(completion_tokens):
+            time.sleep(config.sample(config.token_latency))
+            for choice in choices:
+                delta = ('' if token_index == 0 else ' ') + f"token{token_index}"
+                if chat:
+                    stream_choice = {'index': choice['index'], 'delta': {'content': delta}, 'finish_reason': None}
+                else:
+                    stream_choice = {'index': choice['index'], 'text': delta, 'finish_reason': None}
+                self._write_chunk(f"data: {json.dumps({'id': response_id, 'object': 'chat.completion.chunk' if chat else 'text_completion', 'created': created, 'model': model, 'choices': [stream_choice]})}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+    def _moderation(self, body):
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        results = []
+        for text in inputs:
+            flagged = any(word in text.lower() for word in self.server.config.flagged_words)
+            results.append({'flagged': flagged, 'categories': {'hate': flagged, 'violence': False}, 'category_scores': {'hate': 0.99 if flagged else 0.0, 'violence': 0.0}})
+        self._send_json(200, {'id': f"modr-{uuid.uuid4().hex}", 'model': 'text-moderation-latest', 'results': results})
+
+
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status >= 400 and self.server.config.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.config.retry_after))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def _send_error(self, status, message, error_type):
+        self._send_json(status, {'error': {'message': message, 'type': error_type, 'param': None, 'code': None}})
+
+
+    def _count(self, name):
+        with self.server.stats_lock:
+            self.server.stats['requests'][name] = self.server.stats['requests'].get(name, 0) + 1
+
+
+    def _add_tokens(self, prompt_tokens, completion_tokens):
+        with self.server.stats_lock:
+            self.server.stats['prompt_tokens'] += prompt_tokens
+            self.server.stats['completion_tokens'] += completion_tokens
+
+
+class mock_server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # the default listen backlog of 5 drops connections under load tests, which then stall for a SYN retry 
+    request_queue_size = 128
+
+    def __init__(self, config=None, port=0):
+        super().__init__(('127.0.0.1', port), _mock_handler)
+        self.config = config or mock_config()
+        self.stats = {'requests': {}, 'prompt_tokens': 0, 'completion_tokens': 0}
+        self.stats_lock = threading.Lock()
+        # the latest request bodies, for tests that check what the client sent 
+        self.request_bodies = collections.deque(maxlen=1000)
+
+
+    def handle_error(self, request, client_address):
+        # clients that give up on a request (deadlines, hedging) close the socket mid-response 
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+    @property
+    def api_base(self):
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+
+@contextlib.contextmanager
+def run_mock_server(**config):
+    """Starts a mock server in the background and points the openai client at it for the duration"""
+    server = mock_server(mock_config(**config))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    real_api_base = openai.api_base
+    openai.api_base = server.api_base
+    try:
+        yield server
+    finally:
+        openai.api_base = real_api_base
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5, help="Median response latency in seconds (lognormal)")
+    parser.add_argument('--error-rate-429', type=float, default=0.0)
+    parser.add_argument('--error-rate-5xx', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = mock_server(mock_config(latency=('lognormal', args.latency, 0.5), error_rate_429=args.error_rate_429, error_rate_5xx=args.error_rate_5xx), port=args.port)
+    print(f"Mock OpenAI API listening on {server.api_base}; set OPENAI_API_BASE to use it")
+    server.serve_forever()
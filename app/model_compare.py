@@ -1,6 +1,17 @@
 import streamlit as st  
 import api_util as api 
 import logging 
+import os 
+import concurrent.futures
+import cache_util
+import rate_limit
+import hashlib
+import model_registry
+import instrumentation
+import collections
+import conversation_store
+import pricing
+import uuid
 
 st.set_page_config(layout="wide")
 
@@ -9,34 +20,101 @@ help_msg_model_temperature = "Controls how creativity in AI's response"
 help_msg_model_top_p = "Prevents AI from giving certain answers that are too obvious"
 help_msg_model_freq_penalty = "Encourages AI to be more diverse in its answers"
 help_msg_model_presence_penalty = "Prevents AI from repeating itself too much"
+help_msg_concurrent_fetch = "Sends the requests to all models at the same time, so a round takes about as long as the slowest model instead of the sum of all of them"
+help_msg_stream_responses = "Shows the responses as the models write them, instead of waiting for complete answers. Prompt token counts are estimated when streaming"
+help_msg_cache_responses = "Reuses earlier responses to identical requests instead of paying for them again. Only responses at temperature 0 are cached, since other settings are meant to vary between calls. Streamed responses are not cached"
+help_msg_optimistic_moderation = "Starts fetching model responses while your messages are still being moderated, and discards them if anything is flagged. Saves a network round trip per request, at the cost of paying for responses that get discarded"
+help_msg_deadline = "Stops waiting for a model after this many seconds and shows it as timed out, so one slow model can't hold up the others. 0 waits as long as it takes"
+help_msg_hedge_requests = "When a response is slower than 95% of that model's earlier responses, sends the same request again and keeps whichever answer comes back first. The duplicate requests are paid for, up to a small spending cap per session. Streamed responses are not hedged"
+help_msg_sweep = "Samples every combination of the temperatures and top P values below, several times each, instead of one response at the slider settings. Samples of a setting are fetched in one request per model. Sweep results are not added to the chat histories"
+help_msg_sweep_values = "Comma-separated values between 0 and 1"
+help_msg_sweep_samples = "Responses per model for each combination of settings"
+help_msg_reload_test = "Every test is saved as you go. Enter the ID of an earlier test to pick its conversations up where you left off"
+help_msg_trim_policy = "How to drop messages when a chat session outgrows a model's context window. Both drop the oldest messages first and always keep your latest message"
+trim_policy_labels = {'pinned_system': 'Keep initial prompt, drop oldest messages', 'sliding_window': 'Drop oldest messages, including initial prompt'}
 help_msg_max_token = "OpenAI sets a limit on the number of tokens, or individual units of text, that each language model can generate in a single response. For example, text-davinci-003 has a limit of 4000 tokens, while other models have a limit of 2000 tokens. It's important to note that this limit is inclusive of the length of the initial prompt and all messages in the chat session. To ensure the best results, adjust the max token per response based on your specific use case and anticipated dialogue count and length in a session."
-helper_app_start = "Enter an initial prompt and, optionally a follow-up message, and click on _Fetch AI Responses_ to get responses from the OpenAI models. Each time you click on _Fetch AI Responses_, the app will add the AI responses and the user messages to the chat histories of each model. You can also adjust the model parameters and keep adding follow-up messages to test the model further. To start a new test with fresh chat histories, click on _Start a new Test_. Please note the chat messages are not truncated, so you should pay attention to the total token count of your chat sessions and ensure they are within the maximum token limit of the models."
+helper_app_start = "Enter an initial prompt and, optionally a follow-up message, and click on _Fetch AI Responses_ to get responses from the OpenAI models. Each time you click on _Fetch AI Responses_, the app will add the AI responses and the user messages to the chat histories of each model. You can also adjust the model parameters and keep adding follow-up messages to test the model further. To start a new test with fresh chat histories, click on _Start a new Test_. When a chat session outgrows a model's context window, the oldest messages are left out of the request so it still fits, and the sidebar shows an estimate of each model's prompt tokens before you fetch."
 helper_app_need_api_key = "Welcome! This app allows you to test the effectiveness of your prompts using OpenAI's text models: gpt-3.5-turbo, text-davinci-003, and gpt-4 (if you have access to it). To get started, simply enter your OpenAI API Key below."
 helper_api_key_prompt = "The model comparison tool works best with pay-as-you-go API keys. Free trial API keys are limited to 3 requests a minute, not enough to test your prompts. For more information on OpenAI API rate limits, check [this link](https://platform.openai.com/docs/guides/rate-limits/overview).\n\n- Don't have an API key? No worries! Create one [here](https://platform.openai.com/account/api-keys).\n- Want to upgrade your free-trial API key? Just enter your billing information [here](https://platform.openai.com/account/billing/overview)."
 helper_api_key_placeholder = "Paste your OpenAI API key here (sk-...)"
 
+# fragments (Streamlit 1.33+) rerun just their own part of the page when one of their widgets changes; 
+# with the pinned 1.21 this is a no-op and every widget change reruns the whole script, which the history window keeps cheap 
+_fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None) or (lambda func: func)
+
+
+@st.cache_resource
+def get_response_cache():
+    """Process-wide response cache, shared across sessions; set MODEL_COMPARE_CACHE_PATH to add the on-disk tier"""
+    return cache_util.response_cache(db_path=os.environ.get('MODEL_COMPARE_CACHE_PATH'))
+
+
+# bounded, so keys that are never used again don't keep a pool for the life of the process; idle pools close their sockets on their own 
+@st.cache_resource(max_entries=100)
+def get_connection_pool(api_key_hash):
+    """Keep-alive connection pool per API key, shared across reruns and sessions; sized by MODEL_COMPARE_POOL_SIZE and MODEL_COMPARE_POOL_IDLE_TIMEOUT"""
+    return api.connection_pool(
+        pool_size=int(os.environ.get('MODEL_COMPARE_POOL_SIZE', 10)), 
+        idle_timeout=float(os.environ.get('MODEL_COMPARE_POOL_IDLE_TIMEOUT', 90))
+    )
+
+
+@st.cache_resource
+def get_conversation_store():
+    """Process-wide store of the tests' chat histories; MODEL_COMPARE_DB_PATH sets where the SQLite file lives and MODEL_COMPARE_HISTORY_WINDOW how many messages are shown at first"""
+    return conversation_store.conversation_store(
+        db_path=os.environ.get('MODEL_COMPARE_DB_PATH', 'model_compare.sqlite3'), 
+        page_size=int(os.environ.get('MODEL_COMPARE_HISTORY_WINDOW', 20))
+    )
+
+
+@st.cache_resource
+def get_cost_accumulator():
+    """Process-wide usage and cost of every call, tagged with the session and test it belongs to"""
+    return pricing.cost_accumulator()
+
+
+@st.cache_resource
+def get_metrics_store():
+    """Process-wide latency histograms of every OpenAI call, exported from the latency panel"""
+    return instrumentation.histogram_store()
+
+
+def _get_api_key_hash(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def _get_open_ai(api_key):
+    cache = get_response_cache() if st.session_state.get('model_cache_responses', False) else None
+    pool = get_connection_pool(_get_api_key_hash(api_key))
+    # the hooks run on worker threads, which can't reach session_state, so the session's span log is bound here 
+    session_spans = st.session_state.setdefault('latency_spans', collections.deque(maxlen=2000))
+    hedge_budget = st.session_state.setdefault('hedge_budget', api.hedge_budget(max_extra_cost=float(os.environ.get('MODEL_COMPARE_HEDGE_BUDGET', 0.10))))
+    return api.open_ai(api_key=api_key, restart_sequence='|UR|', stop_sequence='|SP|', cache=cache, pool=pool, hooks=[session_spans.append], latency_store=get_metrics_store(), hedge_budget=hedge_budget)
+
+
 # Handlers 
 def handler_verify_key():
     """Handle OpenAI key verification"""
     oai_api_key = st.session_state.open_ai_key_input
-    o = api.open_ai(api_key=oai_api_key, restart_sequence='|UR|', stop_sequence='|SP|')
+    o = _get_open_ai(oai_api_key)
     try: 
-        # make a call to get available models 
-        open_ai_models = o.get_models()
-        st.session_state.openai_model_params = [('gpt-3.5-turbo', 4096), ('text-davinci-003', 4000)]
-
-        # check to see if the API key has access to gpt-4
-        for m in open_ai_models['data']: 
-            if m['id'] == 'gpt-4':
-                st.session_state.openai_model_params = [('gpt-4', 8000), ('gpt-3.5-turbo', 4096), ('text-davinci-003', 4000)]
+        # look up the models the key has access to (cached per key across sessions) 
+        available_models = model_registry.shared_registry.get_models_for_key(o)
+        if len(available_models) == 0:
+            # nothing to compare, so the test stays disabled 
+            st.session_state.test_disabled = True
+            with openai_key_container:
+                st.error(f"This API key has no access to any of the models the app compares ({', '.join(model_registry.MODEL_CAPABILITIES)}).")
+            return
+        st.session_state.openai_model_params = [(m, model_registry.get_context_window(m)) for m in available_models]
         
         st.session_state.openai_models=[model_name for model_name, _ in st.session_state.openai_model_params]            
         st.session_state.openai_models_str = ', '.join(st.session_state.openai_models)
-        st.session_state.chat_histories = {model: [] for model in st.session_state.openai_models}
-        st.session_state.total_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.prompt_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.completion_tokens = {model: 0 for model in st.session_state.openai_models}
-        st.session_state.conversation_cost = {model: 0 for model in st.session_state.openai_models}
+        # the chat histories and token counts live in the conversation store; the session only keeps the test id 
+        st.session_state.test_id = get_conversation_store().create_test(st.session_state.openai_models, api_key_hash=_get_api_key_hash(oai_api_key))
+        st.session_state.response_latency = {model: {} for model in st.session_state.openai_models}
+        st.session_state.sweep_results = {}
 
 
         # store OpenAI API key in session states 
@@ -59,108 +137,278 @@ def handler_fetch_model_responses():
         'temperature': st.session_state.model_temperature,
         'top_p': st.session_state.model_top_p,
         'frequency_penalty': st.session_state.model_frequency_penalty,
-        'presence_penalty': st.session_state.model_presence_penalty
+        'presence_penalty': st.session_state.model_presence_penalty,
+        'trim_policy': st.session_state.get('model_trim_policy', 'pinned_system'),
+        'deadline': st.session_state.get('model_deadline') or None,
+        'hedge': st.session_state.get('model_hedge_requests', False)
     }
 
-    o = api.open_ai(api_key=st.session_state.oai_api_key, restart_sequence='|UR|', stop_sequence='|SP|')
+    sweep = st.session_state.get('model_sweep', False)
+    if sweep:
+        try:
+            param_grid = [
+                {'temperature': temperature, 'top_p': top_p}
+                for temperature in _parse_sweep_values(st.session_state.model_sweep_temperatures, "temperatures")
+                for top_p in _parse_sweep_values(st.session_state.model_sweep_top_p, "top P values")
+            ]
+        except ValueError as e:
+            with openai_key_container:
+                st.error(f"{e}")
+            return
+
+    o = _get_open_ai(st.session_state.oai_api_key)
     progress = 0 
     user_query_moderated = True
 
     init_prompt = st.session_state.init_prompt
 
-    # Moderate prompt  
-    if init_prompt and init_prompt != '':
-        try:
-            moderation_result = o.get_moderation(user_message = init_prompt)
-            if moderation_result['flagged'] == True:
-                user_query_moderated = False 
-                flagged_categories_str = ", ".join(moderation_result['flagged_categories'])
-                with openai_key_container:
-                    st.error(f"⚠️ Your prompt has been flagged by OpenAI's content moderation endpoint due to the following categories: {flagged_categories_str}.  \n" +
-                    "In order to comply with [OpenAI's usage policy](https://openai.com/policies/usage-policies), we cannot send this prompt to the models. Please modify your prompt and try again.")
-        except Exception as e: 
-            logging.error(f"{e}")
-            with openai_key_container:
-                st.error(f"{e}")
-
+    if not init_prompt or init_prompt == '':
+        progress_bar_container.empty()
+        return
 
-    # Moderate follow-up message 
+    # moderate the prompt and the follow-up message together in one batched request 
+    moderation_inputs = [(init_prompt, "Your prompt", "prompt")]
+    user_message = None
     if "user_msg" in st.session_state and st.session_state.user_msg != '':
+        moderation_inputs.append((st.session_state.user_msg, "Your most recent follow up message", "message"))
+        user_message = {'role':'user', 'message':st.session_state.user_msg, 'created_date':api.get_current_time()}
+
+    store = get_conversation_store()
+    test_id = st.session_state.test_id
+    store.set_init_prompt(test_id, init_prompt)
+    messages_by_model = {m: store.get_messages(test_id, m) + ([user_message] if user_message else []) for m in st.session_state.openai_models}
+    context_windows = dict(st.session_state.openai_model_params)
+    model_config_dicts = [{**model_config_template, 'model':m, 'context_window':context_windows[m]} for m in st.session_state.openai_models]
+    max_workers = None if st.session_state.get('model_concurrent_fetch', True) else 1
+    stream_responses = st.session_state.get('model_stream_responses', False)
+
+    # optimistic mode starts the completions alongside moderation and throws them away if anything is flagged; 
+    # streamed responses render as they arrive, so they always wait for moderation 
+    optimistic_responses = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        moderation_future = executor.submit(o.get_moderation, [text for text, _, _ in moderation_inputs])
+
+        if st.session_state.get('model_optimistic_moderation', False) and not stream_responses and not sweep:
+            progress_bar_container.progress(progress, text=f"Getting {st.session_state.openai_models_str} responses")
+            optimistic_responses = []
+            responses = o.get_ai_responses(
+                model_config_dicts=model_config_dicts,
+                init_prompt_msg=init_prompt,
+                messages_by_model=messages_by_model,
+                max_workers=max_workers
+            )
+            for index, response in enumerate(responses):
+                optimistic_responses.append(response)
+                progress = (index + 1) / len(st.session_state.openai_models)
+                progress_bar_container.progress(progress, text=f"Got {response[0]} response ({index + 1} of {len(st.session_state.openai_models)})")
+
         try:
-            moderation_result = o.get_moderation(user_message = st.session_state.user_msg)
-            if moderation_result['flagged'] == True:
-                user_query_moderated = False 
-                flagged_categories_str = ", ".join(moderation_result['flagged_categories'])
-                with openai_key_container:
-                    st.error(f"⚠️ Your most recent follow up message has been flagged by OpenAI's content moderation endpoint due to the following categories: {flagged_categories_str}.  \n" +
-                    "In order to comply with [OpenAI's usage policy](https://openai.com/policies/usage-policies), we cannot send this message to the models. Please modify your message and try again.")
+            for (_, subject, noun), moderation_result in zip(moderation_inputs, moderation_future.result()):
+                if moderation_result['flagged'] == True:
+                    user_query_moderated = False 
+                    flagged_categories_str = ", ".join(moderation_result['flagged_categories'])
+                    with openai_key_container:
+                        st.error(f"⚠️ {subject} has been flagged by OpenAI's content moderation endpoint due to the following categories: {flagged_categories_str}.  \n" +
+                        f"In order to comply with [OpenAI's usage policy](https://openai.com/policies/usage-policies), we cannot send this {noun} to the models. Please modify your {noun} and try again.")
         except Exception as e: 
             logging.error(f"{e}")
             with openai_key_container:
                 st.error(f"{e}")
 
 
-    if init_prompt and init_prompt != '' and user_query_moderated == True:
-        for index, m in enumerate(st.session_state.openai_models): 
-            progress_bar_container.progress(progress, text=f"Getting {m} responses")
-            if "user_msg" in st.session_state and st.session_state.user_msg != '':             
-                st.session_state.chat_histories[m].append({'role':'user', 'message':st.session_state.user_msg, 'created_date':api.get_current_time()})
-            
-            try:
-                b_r = o.get_ai_response(
-                    model_config_dict={**model_config_template, 'model':m}, 
-                    init_prompt_msg=init_prompt, 
-                    messages=st.session_state.chat_histories[m]
-                )
-
-                st.session_state.chat_histories[m].append(b_r['messages'][-1])
-                st.session_state.total_tokens[m]=b_r['total_tokens']
-                st.session_state.prompt_tokens[m]=b_r['prompt_tokens']
-                st.session_state.completion_tokens[m]=b_r['completion_tokens']
-
-                if m == 'gpt-4':
-                    # $0.03 / 1K prompt tokens + $0.06 / 1K completion tokens
-                    st.session_state.conversation_cost[m] = 0.03 * st.session_state.prompt_tokens[m] / 1000 + 0.06 * st.session_state.completion_tokens[m] / 1000
-                elif m == 'gpt-3.5-turbo':
-                    # 0.002 / 1K total tokens 
-                    st.session_state.conversation_cost[m] = 0.002 * st.session_state.total_tokens[m] / 1000
-                elif m == 'text-davinci-003':
-                    # 0.02 / 1K total tokens 
-                    st.session_state.conversation_cost[m] = 0.02 * st.session_state.total_tokens[m] / 1000
-
-                # update the progress bar 
+    if user_query_moderated == True:
+        if user_message is not None and not sweep:
+            # one user turn, shared by every model's history 
+            store.append_user_turn(test_id, user_message['message'], user_message['created_date'])
+
+        if sweep:
+            progress_bar_container.progress(progress, text=f"Sweeping {st.session_state.openai_models_str} over {len(param_grid)} settings")
+            samples = st.session_state.model_sweep_samples
+
+            # each model's sweep batches its own requests, so the models are swept side by side 
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(model_config_dicts)) as executor:
+                futures = {
+                    executor.submit(o.get_ai_sweep, model_config_dict, [(init_prompt, messages_by_model[model_config_dict['model']])], param_grid, samples): model_config_dict['model']
+                    for model_config_dict in model_config_dicts
+                }
+                for index, future in enumerate(concurrent.futures.as_completed(futures)):
+                    m = futures[future]
+                    try:
+                        _handle_model_sweep(m, future.result(), len(param_grid) * samples)
+                    except Exception as e:
+                        _handle_model_error(o, m, e)
+
+                    progress = (index + 1) / len(st.session_state.openai_models)
+                    progress_bar_container.progress(progress, text=f"Got {m} sweep ({index + 1} of {len(st.session_state.openai_models)})")
+
+        elif optimistic_responses is not None:
+            for m, b_r, e in optimistic_responses:
+                if e is None:
+                    _handle_model_response(m, b_r)
+                else:
+                    _handle_model_error(o, m, e)
+
+        elif stream_responses:
+            # render deltas live into a column per model, where the test results will be drawn 
+            stream_columns = progress_bar_container.container().columns(len(st.session_state.openai_models))
+            stream_placeholders = {}
+            streamed_messages = {m: '' for m in st.session_state.openai_models}
+            for index, m in enumerate(st.session_state.openai_models):
+                with stream_columns[index]:
+                    st.write(f'_Conversation with {m}_')
+                    stream_placeholders[m] = st.empty()
+
+            responses = o.stream_ai_responses(
+                model_config_dicts=model_config_dicts,
+                init_prompt_msg=init_prompt,
+                messages_by_model={m: store.get_messages(test_id, m) for m in st.session_state.openai_models},
+                max_workers=max_workers
+            )
+
+            for m, event, e in responses:
+                if e is not None:
+                    _handle_model_error(o, m, e)
+                elif 'delta' in event:
+                    streamed_messages[m] += event['delta']
+                    stream_placeholders[m].markdown(f"**Model:**  \n{streamed_messages[m]}")
+                else:
+                    _handle_model_response(m, event)
+
+        else:
+            progress_bar_container.progress(progress, text=f"Getting {st.session_state.openai_models_str} responses")
+
+            # fan out to all models at once (or one at a time when concurrency is off); results arrive in completion order 
+            responses = o.get_ai_responses(
+                model_config_dicts=model_config_dicts,
+                init_prompt_msg=init_prompt,
+                messages_by_model={m: store.get_messages(test_id, m) for m in st.session_state.openai_models},
+                max_workers=max_workers
+            )
+
+            for index, (m, b_r, e) in enumerate(responses):
+                if e is None:
+                    _handle_model_response(m, b_r)
+                else:
+                    _handle_model_error(o, m, e)
+
+                # update the progress bar as each model finishes, in whatever order 
                 progress = (index + 1) / len(st.session_state.openai_models)
-                progress_bar_container.progress(progress, text=f"Getting {m} responses")
-
-            except o.OpenAIError as e:
-                logging.error(f"{e}")
-                with openai_key_container:
-                    if e.error_type == "RateLimitError" and str(e) == "OpenAI API Error: You exceeded your current quota, please check your plan and billing details.":
-                        st.error(f"{e}  \n  \n**Friendly reminder:** If you are using a free-trial OpenAI API key, this error is caused by the limited rate limits associated with the key. To optimize your experience, we recommend upgrading to the pay-as-you-go OpenAI plan.")
-                    else:
-                        st.error(f"{e}")
-
-            except Exception as e: 
-                with openai_key_container:
-                    st.error(f"{e}")
-                logging.error(f"{e}")
+                progress_bar_container.progress(progress, text=f"Got {m} response ({index + 1} of {len(st.session_state.openai_models)})")
                     
     progress_bar_container.empty()
 
 
+def _handle_model_response(m, b_r):
+    """Appends a model response to the test, with its token counts and cost"""
+    usage = {
+        'total_tokens': b_r['total_tokens'],
+        'prompt_tokens': b_r['prompt_tokens'],
+        'completion_tokens': b_r['completion_tokens'],
+        'cost': _record_cost(m, b_r['prompt_tokens'], b_r['completion_tokens'], b_r.get('cached', False))
+    }
+    response_message = b_r['messages'][-1]
+    get_conversation_store().append_model_turn(st.session_state.test_id, m, response_message['message'], response_message['created_date'], usage)
+    st.session_state.response_latency[m] = {
+        'time_to_first_token': b_r.get('time_to_first_token'),
+        'tokens_per_sec': b_r.get('tokens_per_sec'),
+        'cached': b_r.get('cached', False),
+        'trimmed_messages': b_r.get('trimmed_messages', 0)
+    }
+
+
+def _handle_model_sweep(m, sweep, unbatched_requests):
+    """Keeps a model's latest sweep for the results grid, with its cost"""
+    sweep['cost'] = _record_cost(m, sweep['prompt_tokens'], sweep['completion_tokens'])
+    if sweep['cached_requests'] > 0:
+        _record_cost(m, sweep['cached_prompt_tokens'], sweep['cached_completion_tokens'], cached=True)
+    sweep['unbatched_requests'] = unbatched_requests
+    st.session_state.sweep_results[m] = sweep
+
+
+def _record_cost(m, prompt_tokens, completion_tokens, cached=False):
+    """Adds a call to the session's spend and returns its cost in $; cached responses cost nothing"""
+    session_id = st.session_state.setdefault('session_id', uuid.uuid4().hex[:12])
+    return get_cost_accumulator().record(m, prompt_tokens, completion_tokens, session=session_id, suite=st.session_state.test_id, cached=cached)
+
+
+def _parse_sweep_values(text, label):
+    try:
+        values = sorted({float(value) for value in text.split(',') if value.strip() != ''})
+    except ValueError:
+        raise ValueError(f"The sweep {label} must be comma-separated numbers")
+    if len(values) == 0 or values[0] < 0 or values[-1] > 1:
+        raise ValueError(f"The sweep {label} must be between 0 and 1")
+    return values
+
+
+def _handle_model_error(o, m, e):
+    """Surfaces a model call error"""
+    if isinstance(e, o.DeadlineExceeded):
+        # the rest of the round goes on; the model is shown as timed out in its column 
+        logging.warning(f"{e}")
+        st.session_state.response_latency[m] = {'timed_out': True}
+    elif isinstance(e, o.OpenAIError):
+        logging.error(f"{e}")
+        with openai_key_container:
+            if e.error_type == "RateLimitError" and str(e) == "OpenAI API Error: You exceeded your current quota, please check your plan and billing details.":
+                st.error(f"{e}  \n  \n**Friendly reminder:** If you are using a free-trial OpenAI API key, this error is caused by the limited rate limits associated with the key. To optimize your experience, we recommend upgrading to the pay-as-you-go OpenAI plan.")
+            else:
+                st.error(f"{e}")
+    else: 
+        with openai_key_container:
+            st.error(f"{e}")
+        logging.error(f"{e}")
+
+
 def handler_start_new_test():
     """Start new test"""
-    st.session_state.chat_histories = {model: [] for model in st.session_state.openai_models}
-    st.session_state.total_tokens = {model: 0 for model in st.session_state.openai_models}
-    st.session_state.prompt_tokens = {model: 0 for model in st.session_state.openai_models}
-    st.session_state.completion_tokens = {model: 0 for model in st.session_state.openai_models}
-    st.session_state.conversation_cost = {model: 0 for model in st.session_state.openai_models}
+    st.session_state.test_id = get_conversation_store().create_test(st.session_state.openai_models, api_key_hash=_get_api_key_hash(st.session_state.oai_api_key))
+    st.session_state.response_latency = {model: {} for model in st.session_state.openai_models}
+    st.session_state.sweep_results = {}
+    st.session_state.history_pages = 1
+
+
+def handler_reload_test():
+    """Reopens an earlier test by its id"""
+    test_id = st.session_state.reload_test_id.strip()
+    test = get_conversation_store().get_test(test_id)
+    # another key's test is reported like a missing one, so test ids can't be probed 
+    if test is None or test['api_key_hash'] != _get_api_key_hash(st.session_state.oai_api_key):
+        with openai_key_container:
+            st.error(f"There is no test with the ID {test_id}")
+        return
+
+    # only the test's models that this key can still use are compared 
+    available_models = model_registry.shared_registry.get_models_for_key(_get_open_ai(st.session_state.oai_api_key))
+    models = [m for m in test['models'] if m in available_models]
+    if len(models) == 0:
+        with openai_key_container:
+            st.error(f"This API key has no access to any of the models of the test {test_id} ({', '.join(test['models'])}).")
+        return
+
+    st.session_state.openai_model_params = [(m, model_registry.get_context_window(m)) for m in models]
+    st.session_state.openai_models = models
+    st.session_state.openai_models_str = ', '.join(models)
+    st.session_state.test_id = test_id
+    st.session_state.init_prompt = test['init_prompt']
+    st.session_state.response_latency = {model: {} for model in st.session_state.openai_models}
+    st.session_state.sweep_results = {}
+    st.session_state.history_pages = 1
+
+
+def handler_show_earlier_messages():
+    st.session_state.history_pages = st.session_state.get('history_pages', 1) + 1
+
 
 def ui_sidebar():
     with st.sidebar:
 
-        if "chat_histories" in st.session_state and len(st.session_state.chat_histories[st.session_state.openai_models[-1]]) > 0: 
-            st.button(label="Start a new Test", on_click=handler_start_new_test)
+        if "test_id" in st.session_state:
+            if get_conversation_store().count_turns(st.session_state.test_id) > 0: 
+                st.button(label="Start a new Test", on_click=handler_start_new_test)
+            st.caption(f"Test ID: `{st.session_state.test_id}`")
+            st.text_input(label="Reload a test by ID", key='reload_test_id', help=help_msg_reload_test)
+            st.button(label="Reload Test", on_click=handler_reload_test)
 
             st.write("---")
 
@@ -181,15 +429,83 @@ def ui_sidebar():
             key="user_msg",
             disabled=st.session_state.test_disabled
         )
-        st.number_input(label="Response Token Limit", key='model_max_tokens', min_value=0, max_value=1000, value=300, step=50, help=help_msg_max_token, disabled=st.session_state.test_disabled)
-        st.slider(label="Temperature", min_value=0.0, max_value=1.0, step=0.1, value=0.7, key='model_temperature', help=help_msg_model_temperature, disabled=st.session_state.test_disabled)
-        st.slider(label="Top P", min_value=0.0, max_value=1.0, step=0.1, value=1.0, key='model_top_p', help=help_msg_model_top_p, disabled=st.session_state.test_disabled)
-        st.slider(label="Frequency penalty", min_value=0.0, max_value=1.0, step=0.1, value=0.0, key='model_frequency_penalty', help=help_msg_model_freq_penalty, disabled=st.session_state.test_disabled)
-        st.slider(label="Presence penalty", min_value=0.0, max_value=1.0, step=0.1, value=0.0, key='model_presence_penalty', help=help_msg_model_presence_penalty, disabled=st.session_state.test_disabled)   
-        
+
+        ui_model_parameters()
+
         st.button(label="Fetch AI Responses", on_click=handler_fetch_model_responses, disabled=st.session_state.test_disabled)      
 
+
+@_fragment
+def ui_model_parameters():
+    """Model parameter widgets; changing one reruns only this part of the sidebar, not the transcripts"""
+    if "openai_models" in st.session_state:
+        ui_token_estimate()
+
+    st.number_input(label="Response Token Limit", key='model_max_tokens', min_value=0, max_value=1000, value=300, step=50, help=help_msg_max_token, disabled=st.session_state.test_disabled)
+    st.slider(label="Temperature", min_value=0.0, max_value=1.0, step=0.1, value=0.7, key='model_temperature', help=help_msg_model_temperature, disabled=st.session_state.test_disabled)
+    st.slider(label="Top P", min_value=0.0, max_value=1.0, step=0.1, value=1.0, key='model_top_p', help=help_msg_model_top_p, disabled=st.session_state.test_disabled)
+    st.slider(label="Frequency penalty", min_value=0.0, max_value=1.0, step=0.1, value=0.0, key='model_frequency_penalty', help=help_msg_model_freq_penalty, disabled=st.session_state.test_disabled)
+    st.slider(label="Presence penalty", min_value=0.0, max_value=1.0, step=0.1, value=0.0, key='model_presence_penalty', help=help_msg_model_presence_penalty, disabled=st.session_state.test_disabled)   
+    st.selectbox(label="Context trimming", options=list(trim_policy_labels), format_func=trim_policy_labels.get, key='model_trim_policy', help=help_msg_trim_policy, disabled=st.session_state.test_disabled)
+    st.checkbox(label="Stream responses", value=False, key='model_stream_responses', help=help_msg_stream_responses, disabled=st.session_state.test_disabled)
+    st.checkbox(label="Fetch models concurrently", value=True, key='model_concurrent_fetch', help=help_msg_concurrent_fetch, disabled=st.session_state.test_disabled)
+    st.checkbox(label="Parameter sweep", value=False, key='model_sweep', help=help_msg_sweep, disabled=st.session_state.test_disabled)
+    if st.session_state.get('model_sweep', False):
+        st.text_input(label="Sweep temperatures", value="0, 0.5, 1", key='model_sweep_temperatures', help=help_msg_sweep_values, disabled=st.session_state.test_disabled)
+        st.text_input(label="Sweep top P values", value="1", key='model_sweep_top_p', help=help_msg_sweep_values, disabled=st.session_state.test_disabled)
+        st.number_input(label="Samples per setting", key='model_sweep_samples', min_value=1, max_value=20, value=3, step=1, help=help_msg_sweep_samples, disabled=st.session_state.test_disabled)
+    st.number_input(label="Response deadline (seconds)", key='model_deadline', min_value=0, max_value=300, value=0, step=5, help=help_msg_deadline, disabled=st.session_state.test_disabled)
+    st.checkbox(label="Hedge slow requests", value=False, key='model_hedge_requests', help=help_msg_hedge_requests, disabled=st.session_state.test_disabled)
+    st.checkbox(label="Moderate optimistically", value=False, key='model_optimistic_moderation', help=help_msg_optimistic_moderation, disabled=st.session_state.test_disabled)
+    st.checkbox(label="Cache deterministic responses", value=False, key='model_cache_responses', help=help_msg_cache_responses, disabled=st.session_state.test_disabled)
+    if st.session_state.get('model_cache_responses', False):
+        cache_stats = get_response_cache().stats()
+        st.caption(f"Cache hit rate: {cache_stats['hit_rate']:.0%} ({cache_stats['hits']} hits, {cache_stats['bytes_saved'] / 1024:.1f} KB saved)")
+
+    limiter_metrics = rate_limit.shared_limiter.metrics()
+    if limiter_metrics['acquired'] > 0:
+        st.caption(f"Rate limiter: {limiter_metrics['queue_depth']} queued, mean wait {limiter_metrics['mean_wait_time']:.2f}s, max wait {limiter_metrics['max_wait_time']:.2f}s")
+
+    hedge_budget = st.session_state.get('hedge_budget')
+    if hedge_budget is not None and hedge_budget.hedges > 0:
+        st.caption(f"Hedged requests: {hedge_budget.hedges}, up to ${hedge_budget.spent:.4f} of ${hedge_budget.max_extra_cost:.2f} extra spend")
+
+    if 'session_id' in st.session_state:
+        spend = get_cost_accumulator().totals(where={'session': st.session_state.session_id})
+        if spend['calls'] > 0:
+            # the losing duplicates of hedged requests are abandoned before their usage is known, so they are only in the hedge budget 
+            hedge_note = " (not counting hedged duplicates)" if hedge_budget is not None and hedge_budget.hedges > 0 else ""
+            st.caption(f"Session spend: ${spend['cost']:.4f} over {spend['calls']} calls{hedge_note}, p95 ${spend['p95_cost']:.4f} per call")
+
   
+def ui_token_estimate():
+    """Live estimate of each model's prompt tokens for the next fetch, counted offline"""
+    o = _get_open_ai(st.session_state.oai_api_key)
+    messages = [{'role':'user', 'message':st.session_state.user_msg}] if st.session_state.get('user_msg') else []
+    max_tokens = st.session_state.get('model_max_tokens', 300)
+    store = get_conversation_store()
+
+    estimates = []
+    prompt_tokens_by_model = []
+    for model_name, context_window in st.session_state.openai_model_params:
+        prompt_tokens = o.count_prompt_tokens(model_name, st.session_state.get('init_prompt') or '', store.get_messages(st.session_state.test_id, model_name) + messages)
+        prompt_tokens_by_model.append(prompt_tokens)
+        estimates.append(f"{model_name}: {prompt_tokens:,} + {max_tokens:,} / {context_window:,}")
+    st.caption("Estimated prompt + response tokens / context window  \n" + "  \n".join(estimates))
+
+    # a sweep sends each model's prompt once per setting, with samples completions of it 
+    settings, samples = 1, 1
+    if st.session_state.get('model_sweep', False):
+        try:
+            settings = len(_parse_sweep_values(st.session_state.get('model_sweep_temperatures', '0, 0.5, 1'), "temperatures")) * len(_parse_sweep_values(st.session_state.get('model_sweep_top_p', '1'), "top P values"))
+        except ValueError:
+            pass
+        samples = st.session_state.get('model_sweep_samples', 3)
+    models = [model_name for model_name, _ in st.session_state.openai_model_params]
+    estimate = pricing.shared_table.estimate_batch(models * settings, prompt_tokens_by_model * settings, max_tokens * samples)
+    st.caption(f"Estimated cost of the next fetch: up to ${estimate['total']:.4f}")
+
+
 def ui_introduction():
     col1, col2 = st.columns([6,4])
     col1.text_input(label="Enter OpenAI API Key", key="open_ai_key_input", type="password", autocomplete="current-password", on_change=handler_verify_key, placeholder=helper_api_key_placeholder, help=helper_api_key_prompt)
@@ -200,22 +516,81 @@ def ui_test_result(progress_bar_container):
     progress_bar_container.empty()
 
     if "openai_models" in st.session_state:
-        columns = st.columns(len(st.session_state.openai_models))
-
-        for index, model_name in enumerate(st.session_state.openai_models):
-            if len(st.session_state.chat_histories[model_name])>0:
-                with columns[index]:
-                    st.write(f'_Conversation with {model_name}_')
-                    st.write(f'Total tokens: {st.session_state.total_tokens[model_name]}')
-                    st.write(f'Prompt tokens: {st.session_state.prompt_tokens[model_name]}')
-                    st.write(f'Completion tokens: {st.session_state.completion_tokens[model_name]}')
-                    st.write(f'Total cost: ${st.session_state.conversation_cost[model_name]}')
-                    st.write("---")
-                    for message in st.session_state.chat_histories[model_name]:
-                        if message['role'] == 'user': 
-                            st.markdown(f"**User:**  \n{message['message']}")
-                        else:
-                            st.markdown(f"**Model:**  \n{message['message']}")
+        ui_transcripts()
+
+
+@_fragment
+def ui_transcripts():
+    """A column per model with its stats and the latest window of its history; showing earlier messages reruns only this part"""
+    columns = st.columns(len(st.session_state.openai_models))
+    store = get_conversation_store()
+    usage_by_model = store.get_usage(st.session_state.test_id)
+    # only the latest pages of each history are read for display 
+    history_limit = store.page_size * st.session_state.get('history_pages', 1)
+
+    for index, model_name in enumerate(st.session_state.openai_models):
+        latency = st.session_state.get('response_latency', {}).get(model_name, {})
+        sweep = st.session_state.get('sweep_results', {}).get(model_name)
+        history, has_earlier_messages = store.get_page(st.session_state.test_id, model_name, limit=history_limit)
+        usage = usage_by_model.get(model_name, {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0, 'total_cost': 0.0})
+        if len(history)>0 or latency.get('timed_out', False) or sweep is not None:
+            with columns[index]:
+                st.write(f'_Conversation with {model_name}_')
+                st.write(f'Total tokens: {usage["total_tokens"]}')
+                st.write(f'Prompt tokens: {usage["prompt_tokens"]}')
+                st.write(f'Completion tokens: {usage["completion_tokens"]}')
+                st.write(f'Latest response cost: ${usage["cost"]:.4f}')
+                st.write(f'Total cost: ${usage["total_cost"]:.4f}')
+                if latency.get('timed_out', False):
+                    st.write("_Timed out: no response to the latest message before the deadline_")
+                if latency.get('time_to_first_token') is not None:
+                    st.write(f"Time to first token: {latency['time_to_first_token']:.2f}s")
+                if latency.get('tokens_per_sec') is not None:
+                    st.write(f"Tokens/sec: {latency['tokens_per_sec']:.1f}")
+                if latency.get('cached', False):
+                    st.write("_Latest response served from cache_")
+                if latency.get('trimmed_messages', 0) > 0:
+                    st.write(f"_{latency['trimmed_messages']} earliest messages left out to fit the context window_")
+                if sweep is not None:
+                    ui_sweep_result(sweep)
+                st.write("---")
+                if has_earlier_messages:
+                    st.button(label="Show earlier messages", key=f"show_earlier_{model_name}", on_click=handler_show_earlier_messages)
+                for message in history:
+                    if message['role'] == 'user': 
+                        st.markdown(f"**User:**  \n{message['message']}")
+                    else:
+                        st.markdown(f"**Model:**  \n{message['message']}")
+
+    ui_latency_breakdown()
+
+
+def ui_sweep_result(sweep):
+    """Grid of a model's sweep samples, one row per combination of settings"""
+    cached_note = f" (+{sweep['cached_requests']} from the cache)" if sweep['cached_requests'] > 0 else ''
+    st.write(f"_Parameter sweep: {sweep['requests']} requests{cached_note} instead of {sweep['unbatched_requests']}, ${sweep['cost']:.4f}_")
+    rows = []
+    for result in sweep['results']:
+        row = dict(result['params'])
+        for index, response in enumerate(result['responses']):
+            row[f"sample {index + 1}"] = response
+        if result['error'] is not None:
+            row['error'] = result['error']
+        rows.append(row)
+    st.dataframe(rows)
+
+
+def ui_latency_breakdown():
+    """Where this session's call time went, per model, with exports of the raw spans and the process-wide histograms"""
+    spans = st.session_state.get('latency_spans', [])
+    if len(spans) == 0:
+        return
+
+    with st.expander("Latency breakdown"):
+        st.table(instrumentation.summarize_calls(spans))
+        col1, col2 = st.columns(2)
+        col1.download_button(label="Download session spans (JSONL)", data=instrumentation.spans_to_jsonl(spans), file_name="latency_spans.jsonl", mime="application/jsonl")
+        col2.download_button(label="Download histograms (Prometheus)", data=get_metrics_store().to_prometheus(), file_name="latency_histograms.prom", mime="text/plain")
 
 
 def _ui_link(url, label, font_awesome_icon):
@@ -0,0 +1,63 @@
+import cachetools
+import hashlib
+import threading
+import pricing
+
+
+# what the app knows about each model it can compare, in display order; prices live in the pricing table (pricing.json)
+MODEL_CAPABILITIES = {
+    'gpt-4': {'endpoint': 'chat', 'context_window': 8000},
+    'gpt-3.5-turbo': {'endpoint': 'chat', 'context_window': 4096},
+    'text-davinci-003': {'endpoint': 'completion', 'context_window': 4000}
+}
+CHAT_MODEL_PREFIXES = ('gpt-3.5-turbo', 'gpt-4')
+
+
+def get_capabilities(model):
+    return MODEL_CAPABILITIES.get(model, {})
+
+
+def is_chat_model(model):
+    endpoint = get_capabilities(model).get('endpoint')
+    if endpoint is None:
+        # dated snapshots such as gpt-4-0314 share their family's endpoint
+        return model.startswith(CHAT_MODEL_PREFIXES)
+    return endpoint == 'chat'
+
+
+def get_context_window(model):
+    return get_capabilities(model).get('context_window')
+
+
+def get_pricing(model):
+    return pricing.shared_table.get_rates(model)
+
+
+class model_registry:
+    """Models each API key has access to, fetched once per key and cached with a TTL across sessions"""
+
+    def __init__(self, ttl=3600, max_keys=1024):
+        self._available_models = cachetools.TTLCache(maxsize=max_keys, ttl=ttl)
+        self._lock = threading.Lock()
+
+
+    def get_available_models(self, o):
+        """Set of model ids the client's key can use; o is an api_util.open_ai"""
+        key = hashlib.sha256(o.api_key.encode('utf-8')).hexdigest()
+        with self._lock:
+            available_models = self._available_models.get(key)
+        if available_models is None:
+            available_models = frozenset(m['id'] for m in o.get_models()['data'])
+            with self._lock:
+                self._available_models[key] = available_models
+        return available_models
+
+
+    def get_models_for_key(self, o):
+        """The comparable models the key has access to, in display order"""
+        available_models = self.get_available_models(o)
+        return [model for model in MODEL_CAPABILITIES if model in available_models]
+
+
+# one registry per process, so sessions with the same key share the model list
+shared_registry = model_registry()
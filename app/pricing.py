@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+import numpy as np
+
+
+# $ per 1K prompt and completion tokens for each model; MODEL_COMPARE_PRICING_PATH points at a replacement table
+DEFAULT_PRICING_PATH = os.environ.get('MODEL_COMPARE_PRICING_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pricing.json'))
+GROUP_COLUMNS = ('model', 'session', 'suite')
+
+
+class pricing_table:
+    """Prompt and completion rates per model, in $ per 1K tokens"""
+
+    def __init__(self, rates):
+        self.rates = {model: {'prompt': float(rate['prompt']), 'completion': float(rate['completion'])} for model, rate in rates.items()}
+        # dated snapshots such as gpt-4-0314 are priced like their family, so the longest matching name wins
+        self._prefixes = sorted(self.rates, key=len, reverse=True)
+
+
+    def get_rates(self, model):
+        rates = self.rates.get(model)
+        if rates is None:
+            family = next((prefix for prefix in self._prefixes if model.startswith(prefix)), None)
+            rates = self.rates[family] if family is not None else {'prompt': 0.0, 'completion': 0.0}
+        return rates
+
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        rates = self.get_rates(model)
+        return (rates['prompt'] * prompt_tokens + rates['completion'] * completion_tokens) / 1000
+
+
+    def costs(self, models, prompt_tokens, completion_tokens):
+        """Vectorized cost of many calls, given parallel sequences of models and token counts"""
+        unique_models, model_codes = np.unique(np.asarray(models, dtype=object).astype(str), return_inverse=True)
+        prompt_rates = np.array([self.get_rates(model)['prompt'] for model in unique_models])
+        completion_rates = np.array([self.get_rates(model)['completion'] for model in unique_models])
+        return (prompt_rates[model_codes] * np.asarray(prompt_tokens, dtype=np.float64) + completion_rates[model_codes] * np.asarray(completion_tokens, dtype=np.float64)) / 1000
+
+
+    def estimate_batch(self, models, prompt_tokens, max_tokens):
+        """Pre-flight cost of a queued batch of calls, assuming every completion uses its whole max_tokens budget"""
+        if len(models) == 0:
+            return {'total': 0.0, 'calls': 0, 'by_model': {}}
+        costs = self.costs(models, prompt_tokens, np.broadcast_to(max_tokens, len(models)))
+        unique_models, model_codes = np.unique(np.asarray(models, dtype=object).astype(str), return_inverse=True)
+        by_model = np.bincount(model_codes, weights=costs, minlength=len(unique_models))
+        return {'total': float(costs.sum()), 'calls': len(models), 'by_model': {str(model): float(cost) for model, cost in zip(unique_models, by_model)}}
+
+
+def load_pricing_table(path=DEFAULT_PRICING_PATH):
+    with open(path) as f:
+        return pricing_table(json.load(f))
+
+
+class cost_accumulator:
+    """Token usage and cost of every call, kept in compact NumPy columns that grow by doubling.
+    Model, session and suite labels are stored as integer codes, so aggregations are vectorized over them."""
+
+    def __init__(self, table=None, capacity=1024):
+        self.table = table if table is not None else shared_table
+        self.size = 0
+        self._labels = {column: {} for column in GROUP_COLUMNS}
+        self._codes = {column: np.zeros(capacity, dtype=np.int32) for column in GROUP_COLUMNS}
+        self._prompt_tokens = np.zeros(capacity, dtype=np.int64)
+        self._completion_tokens = np.zeros(capacity, dtype=np.int64)
+        self._costs = np.zeros(capacity, dtype=np.float64)
+        self._lock = threading.Lock()
+
+
+    def record(self, model, prompt_tokens, completion_tokens, session=None, suite=None, cached=False):
+        """Records one call and returns its cost; a response served from the cache costs nothing"""
+        return float(self.record_many([model], [prompt_tokens], [completion_tokens], session, suite, [cached])[0])
+
+
+    def record_many(self, models, prompt_tokens, completion_tokens, session=None, suite=None, cached=None):
+        """Records a batch of calls of one session and suite, and returns their costs.
+        cached flags the calls answered from the response cache, which are recorded at no cost."""
+        costs = self.table.costs(models, prompt_tokens, completion_tokens)
+        if cached is not None:
+            costs[np.asarray(cached, dtype=bool)] = 0.0
+        count = len(costs)
+        with self._lock:
+            self._reserve(self.size + count)
+            rows = slice(self.size, self.size + count)
+            self._codes['model'][rows] = [self._code('model', model) for model in models]
+            self._codes['session'][rows] = self._code('session', session)
+            self._codes['suite'][rows] = self._code('suite', suite)
+            self._prompt_tokens[rows] = prompt_tokens
+            self._completion_tokens[rows] = completion_tokens
+            self._costs[rows] = costs
+            self.size += count
+        return costs
+
+
+    def aggregate(self, by='model', where=None, percentiles=(50, 95)):
+        """Totals, per-call means and cost percentiles for each label of the `by` column (or all calls when by is None).
+        where restricts the calls by label, e.g. {'session': session_id}."""
+        with self._lock:
+            size = self.size
+            labels = {column: dict(self._labels[column]) for column in GROUP_COLUMNS}
+            codes = {column: self._codes[column][:size].copy() for column in GROUP_COLUMNS}
+            prompt_tokens = self._prompt_tokens[:size].copy()
+            completion_tokens = self._completion_tokens[:size].copy()
+            costs = self._costs[:size].copy()
+
+        mask = np.ones(size, dtype=bool)
+        for column, label in (where or {}).items():
+            if label not in labels[column]:
+                return []
+            mask &= codes[column] == labels[column][label]
+
+        group_labels = list(labels[by]) if by is not None else [None]
+        group_codes = codes[by][mask] if by is not None else np.zeros(int(mask.sum()), dtype=np.int32)
+        prompt_tokens, completion_tokens, costs = prompt_tokens[mask], completion_tokens[mask], costs[mask]
+
+        group_count = len(group_labels)
+        calls = np.bincount(group_codes, minlength=group_count)
+        prompt_totals = np.bincount(group_codes, weights=prompt_tokens, minlength=group_count)
+        completion_totals = np.bincount(group_codes, weights=completion_tokens, minlength=group_count)
+        cost_totals = np.bincount(group_codes, weights=costs, minlength=group_count)
+        # the costs are sorted once, by group and then by value, for every percentile; a stable sort of small integer codes is a radix sort 
+        order = np.argsort(costs)
+        order = order[np.argsort(group_codes[order], kind='stable')]
+        cost_percentiles = {q: _group_percentiles(costs[order], calls, q / 100) for q in percentiles}
+
+        rows = []
+        for code in np.flatnonzero(calls):
+            row = {
+                'calls': int(calls[code]),
+                'prompt_tokens': int(prompt_totals[code]),
+                'completion_tokens': int(completion_totals[code]),
+                'cost': float(cost_totals[code]),
+                'mean_cost': float(cost_totals[code] / calls[code])
+            }
+            row.update({f'p{q}_cost': float(values[code]) for q, values in cost_percentiles.items()})
+            rows.append({by: group_labels[code], **row} if by is not None else row)
+        return rows
+
+
+    def totals(self, where=None):
+        rows = self.aggregate(by=None, where=where)
+        return rows[0] if len(rows) > 0 else {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0, 'mean_cost': 0.0}
+
+
+    # helper functions
+    def _code(self, column, label):
+        return self._labels[column].setdefault(label, len(self._labels[column]))
+
+
+    def _reserve(self, size):
+        capacity = len(self._costs)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for column in GROUP_COLUMNS:
+            self._codes[column] = np.resize(self._codes[column], capacity)
+        self._prompt_tokens = np.resize(self._prompt_tokens, capacity)
+        self._completion_tokens = np.resize(self._completion_tokens, capacity)
+        self._costs = np.resize(self._costs, capacity)
+
+
+def _group_percentiles(sorted_values, counts, q):
+    """The q-quantile of each group's values, interpolated linearly as np.percentile does, for all groups at once.
+    sorted_values holds the groups one after another, each sorted ascending, and counts their sizes."""
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    positions = q * np.maximum(counts - 1, 0)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+
+    result = np.full(len(counts), np.nan)
+    present = counts > 0
+    low_values = sorted_values[(starts + lower)[present]]
+    high_values = sorted_values[(starts + upper)[present]]
+    result[present] = low_values + (high_values - low_values) * (positions - lower)[present]
+    return result
+
+
+# one pricing table per process, read from DEFAULT_PRICING_PATH
+shared_table = load_pricing_table()
@@ -0,0 +1,129 @@
+import collections
+import hashlib
+import threading
+import time
+
+
+# (requests per minute, tokens per minute) for pay-as-you-go keys
+DEFAULT_LIMITS = {
+    'gpt-4': (200, 40000),
+    'gpt-3.5-turbo': (3500, 90000),
+    'text-davinci-003': (3500, 350000)
+}
+FALLBACK_LIMIT = (60, 60000)
+
+
+class _bucket_state:
+    """Request and token buckets for one (API key, model) pair, plus the callers queued on them"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_level = float(requests_per_minute)
+        self.token_level = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiting = collections.deque()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.request_level = min(self.request_capacity, self.request_level + elapsed * self.request_capacity / 60)
+        self.token_level = min(self.token_capacity, self.token_level + elapsed * self.token_capacity / 60)
+        self.updated = now
+
+    def time_until_available(self, now, tokens):
+        wait = self.blocked_until - now
+        if self.request_level < 1:
+            wait = max(wait, (1 - self.request_level) * 60 / self.request_capacity)
+        if self.token_level < tokens:
+            wait = max(wait, (tokens - self.token_level) * 60 / self.token_capacity)
+        return wait
+
+
+class rate_limiter:
+    """Client-side token bucket limiter budgeting requests/min and tokens/min per API key and model.
+    Callers queue in arrival order until their call fits the budget, instead of failing."""
+
+    def __init__(self, limits=None):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self._states = {}
+        self._condition = threading.Condition()
+        self._metrics = {'acquired': 0, 'total_wait_time': 0.0, 'max_wait_time': 0.0, 'rate_limited': 0}
+
+
+    def acquire(self, api_key, model, tokens):
+        """Blocks until a call of the estimated token cost fits the budget, and returns how long it waited"""
+        start = time.monotonic()
+        ticket = object()
+
+        with self._condition:
+            state = self._state(api_key, model)
+            # a single call larger than the whole per-minute budget would otherwise never fit
+            tokens = min(tokens, state.token_capacity)
+            state.waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    state.refill(now)
+                    wait = None
+                    if state.waiting[0] is ticket:
+                        wait = state.time_until_available(now, tokens)
+                        if wait <= 0:
+                            state.request_level -= 1
+                            state.token_level -= tokens
+                            break
+                    self._condition.wait(timeout=wait)
+            finally:
+                state.waiting.remove(ticket)
+                self._condition.notify_all()
+
+            waited = time.monotonic() - start
+            self._metrics['acquired'] += 1
+            self._metrics['total_wait_time'] += waited
+            self._metrics['max_wait_time'] = max(self._metrics['max_wait_time'], waited)
+            return waited
+
+
+    def settle(self, api_key, model, estimated_tokens, actual_tokens):
+        """Credits back (or charges) the difference between a call's estimated and actual token usage"""
+        with self._condition:
+            state = self._state(api_key, model)
+            state.refill(time.monotonic())
+            state.token_level = min(state.token_capacity, state.token_level + estimated_tokens - actual_tokens)
+            self._condition.notify_all()
+
+
+    def penalize(self, api_key, model, retry_after):
+        """Holds back every caller on this key and model after the server rate limited us"""
+        with self._condition:
+            state = self._state(api_key, model)
+            state.blocked_until = max(state.blocked_until, time.monotonic() + retry_after)
+            self._metrics['rate_limited'] += 1
+            self._condition.notify_all()
+
+
+    def tokens_per_minute(self, model):
+        """The token budget of a model, which also caps how large a single request can be"""
+        return self.limits.get(model, FALLBACK_LIMIT)[1]
+
+
+    def metrics(self):
+        with self._condition:
+            acquired = self._metrics['acquired']
+            return {
+                **self._metrics,
+                'queue_depth': sum(len(state.waiting) for state in self._states.values()),
+                'mean_wait_time': self._metrics['total_wait_time'] / acquired if acquired > 0 else 0.0
+            }
+
+
+    # helper functions
+    def _state(self, api_key, model):
+        key = (hashlib.sha256(api_key.encode('utf-8')).hexdigest(), model)
+        if key not in self._states:
+            self._states[key] = _bucket_state(*self.limits.get(model, FALLBACK_LIMIT))
+        return self._states[key]
+
+
+# one limiter per process, so concurrent Streamlit sessions share the budget of a key
+shared_limiter = rate_limiter()
@@ -0,0 +1,205 @@
+import pytest
+import time
+import types
+import api_util as api
+import cache_util
+import instrumentation
+import mock_openai
+import rate_limit
+import token_util
+
+
+def _message(role, text):
+    return {'role': role, 'message': text}
+
+
+def test_serialized_history_encodes_appended_messages_only_once():
+    history = api.serialized_history('|SP|', '|UR|')
+    messages = [_message('user', 'hello'), _message('assistant', 'hi')]
+    history.extend(messages)
+    first_encoding = history.oai_messages[0]
+
+    messages = messages + [_message('user', 'again')]
+    history.extend(messages)
+    assert history.oai_messages[0] is first_encoding
+    assert history.prompt == 'hello|SP|hi|UR|again|SP|'
+
+
+def test_serialized_history_resets_for_another_conversation_ending_in_a_shared_message():
+    # two models' histories share their user turns but not their replies
+    hello, again = _message('user', 'hello'), _message('user', 'again')
+    history = api.serialized_history('|SP|', '|UR|')
+    history.extend([hello, _message('assistant', 'reply from gpt-4'), again])
+
+    history.extend([hello, _message('assistant', 'reply from gpt-3.5-turbo'), again])
+    assert [message['content'] for message in history.oai_messages] == ['hello', 'reply from gpt-3.5-turbo', 'again']
+    assert history.prompt == 'hello|SP|reply from gpt-3.5-turbo|UR|again|SP|'
+
+
+def test_serialized_history_resets_when_edited():
+    history = api.serialized_history('|SP|', '|UR|')
+    history.extend([_message('user', 'hello'), _message('assistant', 'hi')])
+    history.extend([_message('user', 'hello')])
+    assert history.prompt == 'hello|SP|'
+
+
+def test_trimmed_conversation_keeps_a_single_serialization_entry():
+    o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None)
+    model_config_dict = {'model': 'text-davinci-003', 'max_tokens': 50, 'context_window': 200}
+    api._serialized_histories.clear()
+    conversation = []
+    for turn in range(300):
+        conversation += [_message('user', f"question {turn}"), _message('assistant', f"answer {turn}")]
+        submit_messages, trimmed_messages = o._fit_context_window(model_config_dict, [_message('system', 'You are helpful')] + conversation)
+        prompt = o._messages_to_oai_prompt_str(submit_messages, conversation)
+        assert prompt == ''.join(message['message'] + ('|UR|' if message['role'] == 'assistant' else '|SP|') for message in submit_messages)
+
+    assert trimmed_messages > 0
+    assert len(api._serialized_histories) == 1
+
+
+def test_stalled_stream_times_out_at_its_deadline():
+    o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None)
+    model_config_dict = {'model': 'gpt-3.5-turbo', 'max_tokens': 5, 'temperature': 0.7, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0, 'deadline': 0.5}
+    with mock_openai.run_mock_server(token_latency=('fixed', 1.0)):
+        with pytest.raises(o.DeadlineExceeded):
+            list(o.stream_ai_response(model_config_dict, 'You are helpful', [_message('user', 'hello')]))
+
+
+def test_failed_attempts_give_back_their_token_reservation():
+    limiter = rate_limit.rate_limiter(limits={'gpt-3.5-turbo': (3500, 60000)})
+    o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=limiter)
+    model_config_dict = {'model': 'gpt-3.5-turbo', 'max_tokens': 2000, 'temperature': 0.7, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0}
+    with mock_openai.run_mock_server(error_rate_5xx=1.0, retry_after=0):
+        with pytest.raises(o.OpenAIError):
+            o.get_ai_response(model_config_dict, 'You are helpful', [_message('user', 'hello')])
+
+    # four attempts of over 2000 tokens each would have left the bucket well under 52000 tokens
+    assert limiter._state('sk-test', 'gpt-3.5-turbo').token_level > 59000
+
+
+def test_streamed_calls_settle_their_token_reservation():
+    limiter = rate_limit.rate_limiter(limits={'gpt-3.5-turbo': (3500, 60000)})
+    o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=limiter)
+    model_config_dict = {'model': 'gpt-3.5-turbo', 'max_tokens': 2000, 'temperature': 0.7, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0}
+    with mock_openai.run_mock_server():
+        events = list(o.stream_ai_response(model_config_dict, 'You are helpful', [_message('user', 'hello')]))
+
+    # the bucket is only short of the tokens the stream used, not of its 2000 token completion budget 
+    assert 60000 - limiter._state('sk-test', 'gpt-3.5-turbo').token_level <= events[-1]['total_tokens'] + 1
+
+
+def test_idle_pool_closes_its_session():
+    pool = api.connection_pool(idle_timeout=0.2)
+    with mock_openai.run_mock_server():
+        o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None, pool=pool)
+        o.get_models()
+        assert pool._session is not None
+        assert not pool.close_if_idle()
+
+        time.sleep(0.3)
+    assert pool.close_if_idle()
+    assert pool._session is None
+    assert pool in api._live_pools
+
+
+def test_moderation_shows_in_the_latency_breakdown():
+    spans = []
+    o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None, hooks=[spans.append])
+    with mock_openai.run_mock_server():
+        o.get_moderation(['hello', 'something flagged'])
+
+    rows = {row['model']: row for row in instrumentation.summarize_calls(spans)}
+    assert rows['moderation']['calls'] == 1
+    assert rows['moderation']['network (s)'] > 0
+
+
+def test_sweep_cache_hits_are_counted_apart():
+    o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None, cache=cache_util.response_cache())
+    model_config_dict = {'model': 'gpt-3.5-turbo', 'max_tokens': 5, 'temperature': 0.0, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0}
+    conversations = [('You are helpful', [_message('user', 'hello')])]
+    with mock_openai.run_mock_server():
+        first = o.get_ai_sweep(model_config_dict, conversations, [{'temperature': 0.0}], samples=2)
+        second = o.get_ai_sweep(model_config_dict, conversations, [{'temperature': 0.0}], samples=2)
+
+    assert first['requests'] == 1 and first['cached_requests'] == 0
+    assert second['requests'] == 0 and second['cached_requests'] == 1
+    assert second['prompt_tokens'] == second['completion_tokens'] == 0
+    assert second['cached_total_tokens'] == first['total_tokens']
+
+
+def _trim_conversation():
+    # a long system prompt, so the two policies keep different windows 
+    return [_message('system', 'You are helpful. ' * 40)] + [_message('user' if index % 2 == 0 else 'assistant', f"message {index}") for index in range(10)]
+
+
+def _context_window(counter, model, messages, kept, max_tokens=50):
+    """The context window whose prompt budget fits exactly the messages at the indexes in kept"""
+    counts = counter.message_counts(model, messages)
+    return sum(counts[index] for index in kept) + max_tokens + token_util.CHAT_TOKENS_PER_REPLY
+
+
+def test_pinned_system_trim_keeps_the_system_prompt_and_latest_messages():
+    counter = token_util.token_counter()
+    messages = _trim_conversation()
+    context_window = _context_window(counter, 'gpt-3.5-turbo', messages, [0, 8, 9, 10])
+
+    kept, dropped = counter.trim_messages('gpt-3.5-turbo', messages, context_window, max_tokens=50, policy='pinned_system')
+    assert kept == [messages[0]] + messages[8:]
+    assert dropped == 7
+
+
+def test_sliding_window_trim_drops_the_system_prompt_like_any_message():
+    counter = token_util.token_counter()
+    messages = _trim_conversation()
+    context_window = _context_window(counter, 'gpt-3.5-turbo', messages, [0, 8, 9, 10])
+
+    kept, dropped = counter.trim_messages('gpt-3.5-turbo', messages, context_window, max_tokens=50, policy='sliding_window')
+    # the system prompt's budget goes to older turns instead 
+    assert kept == messages[1:]
+    assert dropped == 1
+
+
+def test_trim_keeps_a_latest_message_larger_than_the_budget():
+    counter = token_util.token_counter()
+    messages = _trim_conversation()[:5] + [_message('user', 'a very long question ' * 200)]
+    context_window = _context_window(counter, 'gpt-3.5-turbo', messages, [0, 1])
+
+    kept, dropped = counter.trim_messages('gpt-3.5-turbo', messages, context_window, max_tokens=50, policy='pinned_system')
+    assert kept == [messages[0], messages[-1]]
+    kept, dropped = counter.trim_messages('gpt-3.5-turbo', messages, context_window, max_tokens=50, policy='sliding_window')
+    assert kept == [messages[-1]]
+    assert dropped == 5
+
+
+def test_batches_split_at_the_token_budget():
+    assert api.open_ai._batch_prompts([10, 10, 10, 10, 10], 25) == [[0, 1], [2, 3], [4]]
+    # a prompt over the budget on its own still gets a request 
+    assert api.open_ai._batch_prompts([30, 5], 25) == [[0], [1]]
+
+
+def test_batches_split_at_the_prompt_count_cap():
+    batches = api.open_ai._batch_prompts([1] * 45, 10 ** 6)
+    assert [len(batch) for batch in batches] == [api.MAX_PROMPTS_PER_REQUEST, api.MAX_PROMPTS_PER_REQUEST, 5]
+    assert sum(batches, []) == list(range(45))
+
+
+def test_sweep_maps_batched_choices_back_to_their_prompts(monkeypatch):
+    openai = api._import_openai()
+
+    def create(prompt, n, **params):
+        # each choice names the question of its prompt, and they come back out of order 
+        choices = [{'index': index, 'text': f"{prompt[index // n].split('|SP|')[1]} sample {index % n}"} for index in range(len(prompt) * n)]
+        return {'choices': choices[::-1], 'usage': {'prompt_tokens': 1, 'completion_tokens': len(choices), 'total_tokens': 1 + len(choices)}}
+
+    monkeypatch.setattr(api, '_import_openai', lambda: types.SimpleNamespace(Completion=types.SimpleNamespace(create=create), error=openai.error, api_requestor=openai.api_requestor))
+    o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None)
+    model_config_dict = {'model': 'text-davinci-003', 'max_tokens': 5, 'temperature': 0.7, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0}
+    conversations = [('You are helpful', [_message('user', f"question {index}")]) for index in range(3)]
+
+    sweep = o.get_ai_sweep(model_config_dict, conversations, [{'temperature': 0.7}], samples=2)
+    assert sweep['requests'] == 1
+    for result in sweep['results']:
+        assert result['error'] is None, result['error']
+        question = f"question {result['conversation']}"
+        assert result['responses'] == [f"{question} sample 0", f"{question} sample 1"]
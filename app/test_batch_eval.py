@@ -0,0 +1,53 @@
+import json
+import pyarrow.parquet as pq
+import api_util as api
+import batch_eval
+import mock_openai
+
+
+def _write_suite(tmp_path):
+    suite_path = tmp_path / 'suite.jsonl'
+    suite_path.write_text('{"id": "a", "prompt": "You are nice.", "messages": ["Hi there"]}\n{"id": "b", "prompt": "Be terse."}\n')
+    return str(suite_path)
+
+
+def _client():
+    return api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None)
+
+
+def test_resume_after_a_partial_last_line(tmp_path):
+    suite_path, output_path = _write_suite(tmp_path), tmp_path / 'results.jsonl'
+    with mock_openai.run_mock_server():
+        batch_eval.run_suite(_client(), suite_path, str(output_path), ['gpt-3.5-turbo'])
+        # a crash mid-write leaves the last result cut short
+        lines = output_path.read_text().splitlines(keepends=True)
+        output_path.write_text(lines[0] + lines[1][:20])
+
+        stats = batch_eval.run_suite(_client(), suite_path, str(output_path), ['gpt-3.5-turbo'])
+
+    assert stats['completed'] == 1 and stats['skipped'] == 1
+    records = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert sorted(record['prompt_id'] for record in records) == ['a', 'b']
+
+
+def test_parquet_keeps_every_column_when_the_first_result_is_an_error(tmp_path):
+    output_path, parquet_path = tmp_path / 'results.jsonl', tmp_path / 'results.parquet'
+    error = {'id': 'a|gpt-4|x', 'prompt_id': 'a', 'model': 'gpt-4', 'params': {}, 'error': 'Timed out', 'finished_at': '2023-04-01T00:00:00'}
+    result = {**error, 'id': 'b|gpt-4|x', 'prompt_id': 'b', 'error': None, 'response': 'hi', 'total_tokens': 3, 'prompt_tokens': 2, 'completion_tokens': 1, 'cached': False, 'latency': 0.1, 'cost': 0.0001}
+    output_path.write_text(json.dumps(error) + '\n' + json.dumps(result) + '\n{"id": "c|gpt')
+
+    batch_eval.write_parquet(str(output_path), str(parquet_path))
+
+    table = pq.read_table(str(parquet_path))
+    assert table.num_rows == 2
+    assert {'response', 'total_tokens', 'cost'} <= set(table.column_names)
+    assert table.column('response').to_pylist() == [None, 'hi']
+
+
+def test_default_ids_survive_lines_being_added(tmp_path):
+    suite_path = tmp_path / 'suite.jsonl'
+    suite_path.write_text('{"prompt": "Be terse."}\n')
+    ids = [entry['id'] for entry in batch_eval.load_suite(str(suite_path))]
+
+    suite_path.write_text('{"prompt": "You are nice.", "messages": ["Hi there"]}\n\n{"prompt": "Be terse."}\n')
+    assert [entry['id'] for entry in batch_eval.load_suite(str(suite_path))][1:] == ids
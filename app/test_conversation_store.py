@@ -0,0 +1,53 @@
+import api_util as api
+import conversation_store
+import mock_openai
+import sqlite3
+
+
+MODELS = ['gpt-4', 'gpt-3.5-turbo', 'text-davinci-003']
+MODEL_CONFIG = {'max_tokens': 50, 'temperature': 0.7, 'top_p': 1.0, 'frequency_penalty': 0.0, 'presence_penalty': 0.0}
+
+
+def test_each_model_is_sent_only_its_own_history(tmp_path):
+    store = conversation_store.conversation_store(str(tmp_path / 'test.sqlite3'))
+    test_id = store.create_test(MODELS, 'You are helpful')
+    o = api.open_ai(api_key='sk-test', restart_sequence='|UR|', stop_sequence='|SP|', rate_limiter=None)
+
+    with mock_openai.run_mock_server() as server:
+        for _ in range(2):
+            # the app reads every history for its token estimate before the user turn is stored, so they are cached
+            for model in MODELS:
+                store.get_messages(test_id, model)
+            store.append_user_turn(test_id, 'hello', api.get_current_time())
+
+            # one model at a time, so a history cached by one model is there when the next one is serialized
+            responses = o.get_ai_responses(
+                model_config_dicts=[{**MODEL_CONFIG, 'model': model} for model in MODELS],
+                init_prompt_msg='You are helpful',
+                messages_by_model={model: store.get_messages(test_id, model) for model in MODELS},
+                max_workers=1
+            )
+            for model, b_r, e in responses:
+                assert e is None
+                store.append_model_turn(test_id, model, f"reply from {model}", b_r['messages'][-1]['created_date'])
+
+    bodies = {body['model']: body for body in list(server.request_bodies)[-len(MODELS):]}
+    for model in ('gpt-4', 'gpt-3.5-turbo'):
+        assert [message['content'] for message in bodies[model]['messages']] == ['You are helpful', 'hello', f"reply from {model}", 'hello']
+    assert bodies['text-davinci-003']['prompt'] == 'You are helpful|SP|hello|SP|reply from text-davinci-003|UR|hello|SP|'
+    store.close()
+
+
+def test_tests_created_before_key_ownership_are_migrated(tmp_path):
+    db_path = str(tmp_path / 'test.sqlite3')
+    db = sqlite3.connect(db_path)
+    db.execute("CREATE TABLE tests (test_id TEXT PRIMARY KEY, models TEXT NOT NULL, init_prompt TEXT NOT NULL, created REAL NOT NULL)")
+    db.execute("INSERT INTO tests VALUES ('old', '[\"gpt-4\"]', '', 0)")
+    db.commit()
+    db.close()
+
+    store = conversation_store.conversation_store(db_path)
+    assert store.get_test('old')['api_key_hash'] is None
+    test_id = store.create_test(MODELS, api_key_hash='abc')
+    assert store.get_test(test_id)['api_key_hash'] == 'abc'
+    store.close()
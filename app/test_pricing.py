@@ -0,0 +1,33 @@
+import numpy as np
+import pricing
+
+
+TABLE = pricing.pricing_table({'gpt-4': {'prompt': 0.03, 'completion': 0.06}, 'gpt-3.5-turbo': {'prompt': 0.002, 'completion': 0.002}})
+
+
+def test_cached_responses_cost_nothing():
+    accumulator = pricing.cost_accumulator(TABLE)
+    assert accumulator.record('gpt-4', 1000, 1000) == 0.09
+    assert accumulator.record('gpt-4', 1000, 1000, cached=True) == 0.0
+    assert accumulator.totals()['cost'] == 0.09
+    assert accumulator.totals()['calls'] == 2
+
+
+def test_aggregate_matches_numpy_percentiles():
+    accumulator = pricing.cost_accumulator(TABLE, capacity=4)
+    generator = np.random.default_rng(0)
+    models = generator.choice(['gpt-4', 'gpt-3.5-turbo'], size=500)
+    prompt_tokens = generator.integers(1, 3000, size=500)
+    completion_tokens = generator.integers(1, 500, size=500)
+    accumulator.record_many(list(models), prompt_tokens, completion_tokens, session='s')
+
+    for row in accumulator.aggregate(by='model', percentiles=(50, 95)):
+        costs = TABLE.costs(models[models == row['model']], prompt_tokens[models == row['model']], completion_tokens[models == row['model']])
+        assert row['calls'] == len(costs)
+        assert np.isclose(row['cost'], costs.sum())
+        assert np.allclose([row['p50_cost'], row['p95_cost']], np.percentile(costs, [50, 95]))
+
+
+def test_dated_snapshots_are_priced_like_their_family():
+    assert TABLE.get_rates('gpt-4-0314') == TABLE.get_rates('gpt-4')
+    assert TABLE.get_rates('unknown-model') == {'prompt': 0.0, 'completion': 0.0}
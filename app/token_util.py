@@ -0,0 +1,91 @@
+import cachetools
+import functools
+import hashlib
+import logging
+import threading
+import model_registry
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# chat models wrap every message in a few formatting tokens, and prime the reply with a few more
+CHAT_TOKENS_PER_MESSAGE = 3
+CHAT_TOKENS_PER_REPLY = 3
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Returns the tiktoken encoding for a model, or None when tiktoken or its BPE files are unavailable"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        logging.warning(f"Falling back to estimated token counts for {model}: {e}")
+        return None
+
+
+def count_text_tokens(text, model):
+    encoding = get_encoding(model)
+    if encoding is None:
+        # roughly four characters per token for English text
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class token_counter:
+    """Counts prompt tokens offline. Per-message counts are memoized by content,
+    so a growing history only tokenizes the messages that are new since the last count."""
+
+    def __init__(self, max_entries=16384):
+        self._counts = cachetools.LRUCache(maxsize=max_entries)
+        self._lock = threading.Lock()
+
+
+    def count_message(self, model, text):
+        key = (model, hashlib.sha1(text.encode('utf-8')).digest())
+        with self._lock:
+            count = self._counts.get(key)
+        if count is None:
+            count = count_text_tokens(text, model)
+            with self._lock:
+                self._counts[key] = count
+        return count
+
+
+    def message_counts(self, model, messages, separator_tokens=0):
+        """Token cost of each message as submitted, including its chat framing or prompt separator"""
+        overhead = CHAT_TOKENS_PER_MESSAGE if model_registry.is_chat_model(model) else separator_tokens
+        return [self.count_message(model, message['message']) + overhead for message in messages]
+
+
+    def count_messages(self, model, messages, separator_tokens=0):
+        reply_priming = CHAT_TOKENS_PER_REPLY if model_registry.is_chat_model(model) else 0
+        return sum(self.message_counts(model, messages, separator_tokens)) + reply_priming
+
+
+    def trim_messages(self, model, messages, context_window, max_tokens, policy='pinned_system', separator_tokens=0):
+        """Drops the oldest messages until the prompt plus the response budget fits the context window.
+        'pinned_system' always keeps the leading system prompt, 'sliding_window' treats it like any other message.
+        The latest message is always kept. Returns (kept messages, number of messages dropped)."""
+        budget = context_window - max_tokens - (CHAT_TOKENS_PER_REPLY if model_registry.is_chat_model(model) else 0)
+        counts = self.message_counts(model, messages, separator_tokens)
+        if sum(counts) <= budget or len(messages) == 0:
+            return messages, 0
+
+        pinned = 1 if policy == 'pinned_system' and messages[0]['role'] == 'system' else 0
+        used = sum(counts[:pinned]) + counts[-1]
+        start = len(messages) - 1
+        while start - 1 >= pinned and used + counts[start - 1] <= budget:
+            start -= 1
+            used += counts[start]
+
+        kept = messages[:pinned] + messages[start:]
+        return kept, len(messages) - len(kept)
+
+
+# one counter per process, so the memoized counts are shared across sessions
+shared_counter = token_counter()